@@ -12,6 +12,8 @@ import aiohttp
 import aiohttp.web
 
 
+import learning_observer.kvs
+import learning_observer.log_event
 import learning_observer.module_loader
 from learning_observer.log_event import debug_log
 from learning_observer.util import clean_json
@@ -43,6 +45,8 @@ async def system_status(request):
     - Loaded modules
     - Available URLs
     - System resource usage
+    - Open event log files
+    - KVS operation counts
 
     This returns JSON, which renders very nicely in Firefox, but might
     be handled by a client-side app at some point. If that happens, we
@@ -73,6 +77,8 @@ async def system_status(request):
     status = {
         "status": "Alive!",
         "resources": machine_resources(),
+        "event_log_files": learning_observer.log_event.log_file_metrics(),
+        "kvs_operations": learning_observer.kvs.kvs_metrics(),
         "modules": {
             "course_aggregators": clean_json(learning_observer.module_loader.course_aggregators()),
             "reducers": clean_json(learning_observer.module_loader.reducers()),
@@ -0,0 +1,305 @@
+'''
+Backfilling reducers from logs
+==============================
+
+When we add a reducer (or change one), it only sees events from then
+on. Teachers would like to see the whole semester. Here, we replay the
+study logs through the new reducer in the background, and once it has
+caught up with the logs, we swap it into the live event pipeline.
+
+* We keep a per-file byte offset, which we checkpoint in the KVS every
+  `backfill_checkpoint_events` events. If the server restarts half-way
+  through, we pick up where we left off. Events between the last
+  checkpoint and a crash are replayed, so reducers see them twice;
+  with the default checkpoint interval, that's a small blip.
+* Files are read a line at a time, starting from the checkpoint, and
+  we only advance past complete lines, so it's safe to read logs which
+  are still being written.
+* We make passes over the logs until one finds little that's new
+  (less than a checkpoint's worth), or finds no fewer new events than
+  the pass before. On a busy server, the second is what stops us: each
+  pass picks up what came in during the last one, and that stops
+  shrinking once we're keeping pace with the traffic.
+* Then we swap the reducer in. Connections check for new reducers on
+  each event, so from the swap on, every connection (old or new) runs
+  it live. We note how long each log is at the swap, and make one last
+  pass up to there, for events which came in after our last pass but
+  before the swap. Anything past that was run live, so we don't touch
+  it.
+* The last pass races live events for the students in it, so a few
+  events around the swap can be applied out of order (and an event
+  being logged at the moment of the swap may be counted twice, or
+  missed). The busier the server, the bigger that window.
+
+This swaps the reducer in for this process. If we're running several
+processes, each needs its own swap.
+
+To upgrade a reducer which is already running, backfill a `versioned`
+copy of the new version (see `kvs_pipeline`), with `replaces` set to
+the running one. The copy has keys of its own, so the old version
+keeps running, and its data stays on dashboards, until the swap moves
+readers and writers over together. Then we remove the old version's
+keys. Connections which were idle at the swap write back what the old
+version had cached in memory when they next send an event, which can
+leave a few (unindexed) old keys behind.
+'''
+
+import asyncio
+import datetime
+import gzip
+import json
+import os
+
+import pmss
+
+import learning_observer.incoming_student_event
+import learning_observer.kvs
+import learning_observer.module_loader
+import learning_observer.paths as paths
+import learning_observer.settings
+import learning_observer.stream_analytics
+import learning_observer.stream_analytics.helpers as helpers
+
+from learning_observer.log_event import debug_log
+
+
+pmss.register_field(
+    name='backfill_checkpoint_events',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='When backfilling a reducer from logs, how many events to '\
+                'process between checkpoints of our position in each file.',
+    default=1000
+)
+
+CHECKPOINT_PREFIX = "Backfill"
+
+# Reducer ID -> running backfill task
+BACKFILLS = {}
+
+
+def backfill_files(before=None):
+    '''
+    The study logs, oldest first. These have complete events, with
+    the connection metadata.
+
+    If `before` is given (an ISO timestamp), only logs from connections
+    opened before then.
+    '''
+    files = sorted(
+        f for f in os.listdir(paths.logs())
+        if f.endswith(('.study.log', '.study.log.gz'))
+    )
+    if before is not None:
+        files = [f for f in files if f < before]
+    return [paths.logs(f) for f in files]
+
+
+def checkpoint_key(reducer_id, file_path):
+    '''
+    Where we keep our position in `file_path`.
+
+    >>> checkpoint_key('writing_observer.reconstruct', '/logs/a.study.log')
+    'Backfill,writing_observer.reconstruct,a.study.log'
+    '''
+    return ",".join([CHECKPOINT_PREFIX, reducer_id, os.path.basename(file_path)])
+
+
+async def load_checkpoints(reducer_id, kvs):
+    '''
+    Returns a dictionary of file name -> byte offset
+    '''
+    prefix = ",".join([CHECKPOINT_PREFIX, reducer_id, ""])
+    keys = [key async for key in kvs.iter_keys(prefix=prefix)]
+    values = await kvs.multiget(keys)
+    return {
+        key[len(prefix):]: value['offset']
+        for key, value in zip(keys, values)
+        if value is not None
+    }
+
+
+async def clear_checkpoints(reducer_id, kvs):
+    '''
+    Forget our position in all files, so the next backfill starts over
+    '''
+    prefix = ",".join([CHECKPOINT_PREFIX, reducer_id, ""])
+    keys = [key async for key in kvs.iter_keys(prefix=prefix)]
+    for key in keys:
+        await kvs.remove(key)
+
+
+def read_events(file_path, offset=0, end=None):
+    '''
+    Yield `(offset, event)` for each complete line of `file_path` after
+    byte `offset` (and, if given, ending by byte `end`). The offset is
+    where the next line starts, so it's what we'd checkpoint after
+    processing the event. For compressed logs, offsets are into the
+    uncompressed data.
+    '''
+    opener = gzip.open if file_path.endswith('.gz') else open
+    with opener(file_path, 'rb') as fp:
+        fp.seek(offset)
+        for line in fp:
+            if not line.endswith(b'\n'):
+                # Still being written
+                return
+            if end is not None and offset + len(line) > end:
+                return
+            offset += len(line)
+            line = line.split(b'\t', 1)[0].strip()
+            if line:
+                yield offset, json.loads(line)
+
+
+def compile_reducer(reducer):
+    '''
+    A `ReducerSpec` for a reducer, as it'd be in `module_loader.reducers()`
+    '''
+    return learning_observer.stream_analytics.compile_reducer(
+        reducer['function'],
+        scope=reducer.get('scope', helpers.Scope([helpers.KeyField.STUDENT])),
+        events=reducer.get('events'),
+        exclude_events=reducer.get('exclude_events')
+    )
+
+
+async def backfill_pass(reducer, spec, files, offsets, kvs, ends=None):
+    '''
+    Run whatever is new in `files` (since `offsets`) through the
+    reducer, updating `offsets` and the checkpoints as we go. If we're
+    given `ends` (file name -> byte offset), we stop there in each file.
+
+    Returns the number of events read (including those for other
+    sources, which we skip).
+    '''
+    checkpoint_events = learning_observer.settings.pmss_settings.backfill_checkpoint_events(types=['reducers'])
+    total = 0
+    for file_path in files:
+        name = os.path.basename(file_path)
+        pipelines = {}
+        pending = 0
+
+        async def checkpoint(offset):
+            for pipeline in pipelines.values():
+                await pipeline.flush()
+            offsets[name] = offset
+            await kvs.set(checkpoint_key(reducer['id'], file_path), {'offset': offset})
+
+        offset = offsets.get(name, 0)
+        end = ends.get(name) if ends is not None else None
+        for offset, event in read_events(file_path, offsets.get(name, 0), end):
+            total += 1
+            metadata = event.get('metadata', {})
+            if metadata.get('source') != reducer['context']:
+                continue
+            # Study logs are per-connection, so in practice, this is one pipeline
+            pipeline_key = (metadata.get('source'), metadata.get('auth', {}).get('safe_user_id'))
+            if pipeline_key not in pipelines:
+                pipelines[pipeline_key] = await learning_observer.incoming_student_event.student_event_pipeline(
+                    metadata, analytics_modules=(spec,)
+                )
+            await pipelines[pipeline_key](event)
+            pending += 1
+            if pending >= checkpoint_events:
+                await checkpoint(offset)
+                pending = 0
+        if offset != offsets.get(name, 0):
+            await checkpoint(offset)
+    return total
+
+
+def swap_in(reducer):
+    '''
+    Put `reducer` in the live event pipeline, replacing any old version.
+    This doesn't await, so it's atomic as far as the event loop goes.
+    '''
+    learning_observer.module_loader.remove_reducer(reducer['id'])
+    learning_observer.module_loader.add_reducer(reducer)
+    learning_observer.stream_analytics.init()
+
+
+def log_sizes(files):
+    '''
+    File name -> how far we'd read in each of `files` if we read to the
+    end now. Compressed logs aren't being written to, so we don't need
+    a limit for them.
+    '''
+    return {
+        os.path.basename(f): os.path.getsize(f)
+        for f in files
+        if not f.endswith('.gz')
+    }
+
+
+async def backfill(reducer, restart=False, replaces=None):
+    '''
+    Replay the study logs through `reducer`, swap it into the live
+    pipeline once it has (about) caught up, and then replay whatever
+    was logged between our last pass and the swap.
+
+    If `restart`, we ignore (and clear) checkpoints from an earlier
+    run, e.g. because the reducer has changed since.
+
+    If `replaces` (the running version of the reducer) keeps its
+    state under other keys, we remove them once we're done.
+
+    Returns the number of events read.
+    '''
+    reducer_id = reducer['id']
+    kvs = learning_observer.kvs.KVS()
+    if restart:
+        await clear_checkpoints(reducer_id, kvs)
+    offsets = await load_checkpoints(reducer_id, kvs)
+    spec = compile_reducer(reducer)
+    debug_log("Backfilling", reducer_id, "resuming from", len(offsets), "checkpoints")
+
+    # On a busy server, there's always something new, so "caught up"
+    # means a pass had less than a checkpoint's worth of events, or no
+    # fewer than the last pass (so more passes won't get us closer).
+    caught_up = learning_observer.settings.pmss_settings.backfill_checkpoint_events(types=['reducers'])
+    total = 0
+    previous = None
+    while True:
+        count = await backfill_pass(reducer, spec, backfill_files(), offsets, kvs)
+        total += count
+        if count < caught_up or (previous is not None and count >= previous):
+            break
+        previous = count
+
+    # No awaits from here to the swap, so no events reach the reducers in between
+    swapped_at = datetime.datetime.utcnow().isoformat()
+    files = backfill_files(before=swapped_at)
+    ends = log_sizes(files)
+    swap_in(reducer)
+    debug_log("Backfilled", reducer_id, "with", total, "events. Swapped in at", swapped_at)
+
+    total += await backfill_pass(reducer, spec, files, offsets, kvs, ends=ends)
+    debug_log("Finished backfilling", reducer_id, "with", total, "events")
+
+    if replaces is not None:
+        old_name = helpers.fully_qualified_function_name(replaces['function'])
+        if old_name != helpers.fully_qualified_function_name(reducer['function']):
+            removed = await helpers.remove_reducer_keys(replaces['function'], kvs)
+            debug_log("Removed", removed, "keys of the old version,", old_name)
+    return total
+
+
+def start_backfill(reducer, restart=False, replaces=None):
+    '''
+    Run `backfill` in the background. Returns the task.
+    '''
+    reducer_id = reducer['id']
+    running = BACKFILLS.get(reducer_id)
+    if running is not None and not running.done():
+        raise RuntimeError(f'A backfill of `{reducer_id}` is already running')
+    task = asyncio.create_task(backfill(reducer, restart=restart, replaces=replaces))
+    BACKFILLS[reducer_id] = task
+
+    def finished(task):
+        if BACKFILLS.get(reducer_id) is task:
+            del BACKFILLS[reducer_id]
+        if not task.cancelled() and task.exception() is not None:
+            debug_log("Backfill of", reducer_id, "failed:", task.exception())
+
+    task.add_done_callback(finished)
+    return task
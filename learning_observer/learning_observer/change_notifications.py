@@ -0,0 +1,147 @@
+'''
+KVS change notifications
+========================
+
+Dashboards used to rerun their queries every few seconds, whether or
+not any student had done anything. With change notifications turned
+on, reducers announce which keys they've written, and dashboards rerun
+when data they read changes (and only for the students it changed
+for). An idle classroom costs nothing.
+
+There are two modes (set `change_notifications` under `dashboard`):
+
+* `local`: notifications go to listeners in this process. This is
+  fine with the `stub` KVS, or a single server process.
+* `redis`: notifications are published on a redis channel, so the
+  process serving a dashboard hears about writes made by the process
+  handling the students.
+
+Writes are collected for `change_notification_milliseconds`, and then
+published together, so a busy class is a message every so often,
+rather than one per event. Redis pub/sub doesn't guarantee delivery,
+so listeners shouldn't rely on hearing about every write.
+'''
+
+import asyncio
+import json
+
+import pmss
+
+import learning_observer.redis_connection
+import learning_observer.settings
+from learning_observer.log_event import debug_log
+
+
+pmss.parser('change_notifications', parent='string', choices=['none', 'local', 'redis'], transform=None)
+pmss.register_field(
+    name='change_notifications',
+    type='change_notifications',
+    description='How reducers announce which KVS keys they have written, so '\
+                'dashboards can update when data changes rather than on a timer.\n'\
+                '`none`: no notifications\n'\
+                '`local`: within this process\n'\
+                '`redis`: over redis pub/sub, to all processes',
+    default='none'
+)
+pmss.register_field(
+    name='change_notification_milliseconds',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='How long to collect changed keys for before publishing them.',
+    default=250
+)
+
+CHANNEL = 'learning_observer.changed_keys'
+
+# Functions to call with each set of changed keys
+LISTENERS = []
+
+# Changed keys we haven't published yet
+PENDING = set()
+
+PUBLISH_TASK = None
+REDIS_LISTEN_TASK = None
+
+
+def mode():
+    return learning_observer.settings.pmss_settings.change_notifications(types=['dashboard'])
+
+
+def enabled():
+    '''
+    Are change notifications turned on? This goes through the settings,
+    so callers on hot paths should check once (e.g. per connection).
+    '''
+    return mode() != 'none'
+
+
+def changed(keys):
+    '''
+    Note that `keys` were written. This doesn't wait; we publish in the
+    background.
+    '''
+    global PUBLISH_TASK
+    PENDING.update(keys)
+    if PUBLISH_TASK is None or PUBLISH_TASK.done():
+        PUBLISH_TASK = asyncio.create_task(_publish_pending())
+
+
+async def _publish_pending():
+    global PUBLISH_TASK
+    try:
+        await asyncio.sleep(
+            learning_observer.settings.pmss_settings.change_notification_milliseconds(types=['dashboard']) / 1000
+        )
+    finally:
+        # Whatever happens (e.g. we're cancelled), the next change
+        # should start a new task.
+        PUBLISH_TASK = None
+    keys = set(PENDING)
+    PENDING.clear()
+    if mode() == 'redis':
+        # Our own listener (if any) hears about these through redis
+        try:
+            connection = await learning_observer.redis_connection.connection()
+            await connection.publish(CHANNEL, json.dumps(sorted(keys)))
+        except Exception as e:
+            # Listeners shouldn't rely on every notification anyway
+            debug_log("Could not publish changed keys:", e)
+    else:
+        _notify(keys)
+
+
+def _notify(keys):
+    for listener in list(LISTENERS):
+        try:
+            listener(keys)
+        except Exception as e:
+            debug_log("Error in change listener:", e)
+
+
+async def _listen_redis():
+    global REDIS_LISTEN_TASK
+    try:
+        pubsub = (await learning_observer.redis_connection.connection()).pubsub()
+        await pubsub.subscribe(CHANNEL)
+        async for message in pubsub.listen():
+            if message['type'] == 'message':
+                _notify(set(json.loads(message['data'])))
+    except Exception as e:
+        debug_log("Stopped listening for changes on redis:", e)
+    finally:
+        # The next `listen` will try again
+        REDIS_LISTEN_TASK = None
+
+
+def listen(listener):
+    '''
+    Call `listener` with a set of keys whenever some are changed.
+    '''
+    global REDIS_LISTEN_TASK
+    LISTENERS.append(listener)
+    if mode() == 'redis' and REDIS_LISTEN_TASK is None:
+        REDIS_LISTEN_TASK = asyncio.create_task(_listen_redis())
+
+
+def unlisten(listener):
+    if listener in LISTENERS:
+        LISTENERS.remove(listener)
@@ -7,6 +7,8 @@ The executor processes the `execution_dag` portion of our request.
 import asyncio
 import collections
 import concurrent.futures
+import contextvars
+import copy
 import functools
 import inspect
 
@@ -390,6 +392,67 @@ async def handle_map(functions, function_name, values, value_path, func_kwargs=N
     return output
 
 
+# How many keys `select` fetches from the KVS per round trip
+SELECT_CHUNK_SIZE = 100
+
+# Set by whoever runs a DAG (see `dashboard._run_subscription`). If
+# `SELECTED_KEYS` is a set, `select` adds the keys it reads to it. If
+# `SELECT_STUDENTS` is a set, `select` skips keys for other students
+# (keys without a student are always read).
+SELECTED_KEYS = contextvars.ContextVar('selected_keys', default=None)
+SELECT_STUDENTS = contextvars.ContextVar('select_students', default=None)
+
+
+def key_student(key):
+    """
+    The student a KVS key is for, if any.
+
+    >>> key_student('Internal,writing_observer.reconstruct,STUDENT:123,EventField.doc_id:abc')
+    '123'
+    >>> key_student('Internal,writing_observer.reconstruct,EventField.doc_id:abc') is None
+    True
+    """
+    fields = learning_observer.stream_analytics.helpers.parse_key(key)['fields']
+    return fields.get(learning_observer.stream_analytics.fields.KeyField.STUDENT.name)
+
+
+def _select_fields(k, resulting_value, fields):
+    """
+    Build the response to `select` for one key, `k`, given the value we
+    fetched for it.
+    """
+    # output from query added to response later
+    query_response_element = {
+        'provenance': {
+            'key': k['key'],
+            'provenance': k['provenance']
+        }
+    }
+    if resulting_value is None:
+        # the reducer has not run yet, so we return the default value from the module
+        resulting_value = k['default']
+
+    fields_to_keep = fields
+    if fields is None or fields == learning_observer.communication_protocol.query.SelectFields.Missing:
+        fields_to_keep = {}
+    # keep all current fields except for provenance (already prepared)
+    elif fields == learning_observer.communication_protocol.query.SelectFields.All:
+        fields_to_keep = {k: k for k in resulting_value.keys() if k != 'provenance'}
+
+    for f in fields_to_keep:
+        try:
+            value = get_nested_dict_value(resulting_value, f)
+        except KeyError as e:
+            value = DAGExecutionException(
+                f'KeyError: key `{f}` not found in `{resulting_value.keys()}`',
+                inspect.currentframe().f_code.co_name,
+                {'target': resulting_value, 'key': f, 'exception': e}
+            ).to_dict()
+        # add necessary outputs to query response
+        query_response_element[fields_to_keep[f]] = value
+    return query_response_element
+
+
 @handler(learning_observer.communication_protocol.query.DISPATCH_MODES.SELECT)
 async def handle_select(keys, fields=learning_observer.communication_protocol.query.SelectFields.Missing):
     """
@@ -405,48 +468,50 @@ async def handle_select(keys, fields=learning_observer.communication_protocol.qu
     where the keys are the dot notation you are looking for and the values are
     the key they are returned under.
 
+    We gather up to `SELECT_CHUNK_SIZE` keys at a time, and fetch them
+    with one `multiget`, so selecting a class is a round trip per chunk
+    rather than per student. Results still come out one at a time, in
+    the same order as `keys`.
+
     TODO add in test cases once we pass kvs as a parameter
     """
-    fields_to_keep = fields
-    if fields is None or fields == learning_observer.communication_protocol.query.SelectFields.Missing:
-        fields_to_keep = {}
+    kvs = learning_observer.kvs.KVS()
+    chunk = []
+    selected_keys = SELECTED_KEYS.get()
+    select_students = SELECT_STUDENTS.get()
+
+    async def fetch_chunk():
+        values = await kvs.multiget([k['key'] for k in chunk])
+        return [_select_fields(k, value, fields) for k, value in zip(chunk, values)]
 
     async for k in ensure_async_generator(keys):
-        if isinstance(k, dict) and 'key' in k:
-            # output from query added to response later
-            query_response_element = {
-                'provenance': {
-                    'key': k['key'],
-                    'provenance': k['provenance']
-                }
-            }
-        else:
+        if not (isinstance(k, dict) and 'key' in k):
+            # Send out what came before the bad key, as we would have
+            # if we weren't batching
+            if chunk:
+                for element in await fetch_chunk():
+                    yield element
             raise DAGExecutionException(
                 f'Key not formatted correctly for select: {k}',
                 inspect.currentframe().f_code.co_name,
                 {'keys': keys, 'fields': fields}
             )
-        resulting_value = await learning_observer.kvs.KVS()[k['key']]
-        if resulting_value is None:
-            # the reducer has not run yet, so we return the default value from the module
-            resulting_value = k['default']
-
-        # keep all current fields except for provenance (already prepared)
-        if fields == learning_observer.communication_protocol.query.SelectFields.All:
-            fields_to_keep = {k: k for k in resulting_value.keys() if k != 'provenance'}
-
-        for f in fields_to_keep:
-            try:
-                value = get_nested_dict_value(resulting_value, f)
-            except KeyError as e:
-                value = DAGExecutionException(
-                    f'KeyError: key `{f}` not found in `{resulting_value.keys()}`',
-                    inspect.currentframe().f_code.co_name,
-                    {'target': resulting_value, 'key': f, 'exception': e}
-                ).to_dict()
-            # add necessary outputs to query response
-            query_response_element[fields_to_keep[f]] = value
-        yield query_response_element
+        if selected_keys is not None:
+            selected_keys.add(k['key'])
+        if select_students is not None:
+            # Keys which aren't about one student (e.g. per-document or
+            # per-class) could be needed for any student's results
+            student = key_student(k['key'])
+            if student is not None and student not in select_students:
+                continue
+        chunk.append(k)
+        if len(chunk) >= SELECT_CHUNK_SIZE:
+            for element in await fetch_chunk():
+                yield element
+            chunk = []
+    if chunk:
+        for element in await fetch_chunk():
+            yield element
 
 
 # @handler(learning_observer.communication_protocol.query.DISPATCH_MODES.KEYS)
@@ -640,105 +705,220 @@ async def _clean_json_via_generator(iterator):
         yield clean_json(item)
 
 
-async def execute_dag(endpoint, parameters, functions, target_exports):
+# A compiled, ready-to-run DAG. See `compile_plan`.
+ExecutionPlan = collections.namedtuple('ExecutionPlan', ['steps', 'targets'])
+
+# One node of a compiled plan.
+# * `arguments` are the node's arguments, as written in the DAG, without
+#   the dispatch mode. Shared between runs, so never modified.
+# * `variables` are the `(path, variable_name)` places in `arguments`
+#   which get the results of other nodes.
+# * `dependencies` are the nodes we need results from first.
+# * `error` is set if the node can't be run at all (e.g. it's part of
+#   a cycle, or doesn't exist).
+PlanStep = collections.namedtuple('PlanStep', ['name', 'dispatch', 'arguments', 'variables', 'dependencies', 'error'])
+
+
+def _find_variables(node, path=()):
     """
-    This is the primary way to execute a DAG.
-    Users should pass the overall execution dag dict, a dictionary parameters,
-    a dictionary of available functions, and a list of exports they wish to
-    receive data back for.
+    Where in `node` we need results from other nodes, as
+    `(path, variable_name)`.
 
-    See `learning_observer/communication_protocol/test_cases.py` for usage examples.
+    >>> _find_variables({'a': {'dispatch': 'variable', 'variable_name': 'x'}, 'b': {'c': {'dispatch': 'variable', 'variable_name': 'y'}}, 'd': 1})
+    [(('a',), 'x'), (('b', 'c'), 'y')]
     """
-    target_nodes = [endpoint['exports'][key]['returns'] for key in target_exports]
+    found = []
+    for child_key, child_value in node.items():
+        if not isinstance(child_value, dict):
+            continue
+        if child_value.get(dispatch) == learning_observer.communication_protocol.query.DISPATCH_MODES.VARIABLE:
+            found.append((path + (child_key,), child_value['variable_name']))
+        else:
+            found.extend(_find_variables(child_value, path + (child_key,)))
+    return found
+
 
-    visited = set()
+def _bind_variables(arguments, variables, results):
+    """
+    Fill the results of other nodes into a copy of `arguments`. We only
+    copy the dictionaries along the way to each variable; everything
+    else is shared with the plan.
+
+    >>> arguments = {'a': {'b': 'x', 'c': 1}, 'd': [1]}
+    >>> bound = _bind_variables(arguments, [(('a', 'b'), 'x')], {'x': 5})
+    >>> bound
+    {'a': {'b': 5, 'c': 1}, 'd': [1]}
+    >>> arguments
+    {'a': {'b': 'x', 'c': 1}, 'd': [1]}
+    """
+    if not variables:
+        return arguments
+    bound = dict(arguments)
+    for path, variable_name in variables:
+        container = bound
+        for key in path[:-1]:
+            container[key] = dict(container[key])
+            container = container[key]
+        container[path[-1]] = results[variable_name]
+    return bound
+
+
+def compile_plan(endpoint, target_exports):
+    """
+    Compile an execution DAG into a plan for computing `target_exports`.
+
+    This does all of the work which doesn't depend on parameters:
+    copying and flattening the DAG, finding each node's dependencies,
+    dropping nodes the targets don't need, and ordering the rest so
+    each node comes after everything it depends on. Running the plan
+    (`execute_plan`) then just binds results and dispatches.
+
+    Plans don't change once compiled, so they can be cached and run
+    as often as we like. `endpoint` isn't modified.
+
+    >>> from learning_observer.communication_protocol.query import parameter, call, variable
+    >>> plan = compile_plan({
+    ...     'execution_dag': {'x': parameter('x'), 'y': call('f')(x=variable('x')), 'z': parameter('z')},
+    ...     'exports': {'y': {'returns': 'y'}}
+    ... }, ['y'])
+    >>> [(step.name, step.dependencies) for step in plan.steps], plan.targets
+    ([('x', ()), ('y', ('x',))], ('y',))
+    """
+    endpoint = learning_observer.communication_protocol.util.flatten(copy.deepcopy(endpoint))
     nodes = endpoint['execution_dag']
+    targets = tuple(endpoint['exports'][key]['returns'] for key in target_exports)
+
+    steps = {}  # node name -> step, in topological order
+    in_progress = []
+
+    def error_step(node_name, message, details):
+        return PlanStep(node_name, None, None, (), (), DAGExecutionException(
+            message, 'compile_plan', details
+        ).to_dict())
+
+    def add(node_name):
+        if node_name in steps:
+            return
+        if node_name in in_progress:
+            # The nodes after this one are waiting on it, so it can't wait on them
+            path = in_progress[in_progress.index(node_name):] + [node_name]
+            steps[node_name] = error_step(node_name, f'Cycle in execution DAG: {" -> ".join(path)}', {'node': node_name, 'path': path})
+            return
+        if node_name not in nodes:
+            steps[node_name] = error_step(node_name, f'Node `{node_name}` not found in execution DAG', {'node': node_name})
+            return
+        node = nodes[node_name]
+        variables = ()
+        node_dispatch = None
+        if isinstance(node, dict):
+            variables = tuple(_find_variables(node))
+            node_dispatch = node.get(dispatch)
+            node = {k: v for k, v in node.items() if k != dispatch}
+        in_progress.append(node_name)
+        for path, variable_name in variables:
+            add(variable_name)
+        in_progress.pop()
+        if node_name not in steps:
+            dependencies = tuple(dict.fromkeys(variable_name for path, variable_name in variables))
+            steps[node_name] = PlanStep(node_name, node_dispatch, node, variables, dependencies, None)
+
+    for target in targets:
+        add(target)
+    return ExecutionPlan(tuple(steps.values()), targets)
+
+
+async def _run_step(step, dependencies, parameters, functions):
+    """
+    Run one step of a plan, once all of the steps it depends on are
+    done.
 
-    async def dispatch_node(node):
-        """
-        Dispatch the appropriate server-side function for a given node.
-        """
-        try:
-            if not isinstance(node, dict):
-                return node
-            if dispatch not in node:
-                return node
-            node_dispatch = node[dispatch]
-            function = DISPATCH[node_dispatch]
-            del node[dispatch]
-            # make dispatch specific function call
-            if node_dispatch == learning_observer.communication_protocol.query.DISPATCH_MODES.PARAMETER:
-                result = function(parameters=parameters, **node)
-            elif (node_dispatch == learning_observer.communication_protocol.query.DISPATCH_MODES.CALL
-                  or node_dispatch == learning_observer.communication_protocol.query.DISPATCH_MODES.MAP):
-                result = function(functions=functions, **node)
-            else:
-                result = function(**node)
-            if inspect.isawaitable(result):
-                result = await result
-            return result
-        except DAGExecutionException as e:
-            return e.to_dict()
-
-    async def walk_dict(node_dict):
-        """
-        We walk through the execution DAG backwards. We visit any variable nodes
-        we find and cache their stored value.
-        """
-        for child_key, child_value in list(node_dict.items()):
-            if isinstance(child_value, dict) and dispatch in child_value and child_value[dispatch] == learning_observer.communication_protocol.query.DISPATCH_MODES.VARIABLE:
-                node_dict[child_key] = await visit(child_value['variable_name'])
-            elif isinstance(child_value, dict):
-                await walk_dict(child_value)
-
-    async def visit(node_name):
-        """
-        When executing the DAG, we `visit()` nodes that we want output from.
-        These will either be specified as target_nodes or be any descendents
-        of the target_nodes.
-
-        If we've already visited a node, we return the result.
-        If any of the child nodes return errors, we return them.
-        """
-        # We've already done this one.
-        if node_name in visited:
-            return nodes[node_name]
-
-        # Execute all the child nodes
-        await walk_dict(nodes[node_name])
-
-        # Check for any errors, then dispatch the node
-        # if errors are present, we bubble them up the DAG
-        error, error_path = _has_error(nodes[node_name])
-        if error is not None:
-            nodes[node_name] = {
-                'error': error,
-                'dispatch': nodes[node_name]['dispatch'],
-                'error_path': error_path
-            }
-            error_texts = '\n'.join((f'  {e}' for e in _find_error_messages(error)))
-            tb = nodes[node_name]["error"].get("traceback", 'No traceback available')
-            debug_log('ERROR:: Error occured within execution dag at '\
-                      f'{node_name}\n{tb}\n'\
-                      f'{error_texts}')
+    If any of those returned errors, we return them.
+    """
+    if step.error is not None:
+        return step.error
+    results = dict(zip(step.dependencies, await asyncio.gather(*dependencies)))
+    node = _bind_variables(step.arguments, step.variables, results)
+    if not isinstance(node, dict):
+        return node
+
+    # Check for any errors, then dispatch the node
+    # if errors are present, we bubble them up the DAG
+    error, error_path = _has_error(node)
+    if error is not None:
+        error_texts = '\n'.join((f'  {e}' for e in _find_error_messages(error)))
+        tb = error.get("traceback", 'No traceback available')
+        debug_log('ERROR:: Error occured within execution dag at '\
+                  f'{step.name}\n{tb}\n'\
+                  f'{error_texts}')
+        return {
+            'error': error,
+            'dispatch': step.dispatch,
+            'error_path': error_path
+        }
+    if step.dispatch is None:
+        return node
+
+    try:
+        function = DISPATCH[step.dispatch]
+        # make dispatch specific function call
+        if step.dispatch == learning_observer.communication_protocol.query.DISPATCH_MODES.PARAMETER:
+            result = function(parameters=parameters, **node)
+        elif (step.dispatch == learning_observer.communication_protocol.query.DISPATCH_MODES.CALL
+              or step.dispatch == learning_observer.communication_protocol.query.DISPATCH_MODES.MAP):
+            result = function(functions=functions, **node)
         else:
-            nodes[node_name] = await dispatch_node(nodes[node_name])
+            result = function(**node)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+    except DAGExecutionException as e:
+        return e.to_dict()
+
 
-        visited.add(node_name)
-        return nodes[node_name]
+async def execute_plan(plan, parameters, functions):
+    """
+    Run a plan from `compile_plan` with `parameters`, and return the
+    results for its targets.
+
+    Each node runs once, as soon as the nodes it depends on are done,
+    so independent branches (e.g. a roster and a list of documents)
+    run at the same time.
+    """
+    futures = {}  # node name -> future for its result
+    for step in plan.steps:
+        futures[step.name] = asyncio.ensure_future(_run_step(
+            step, [futures[d] for d in step.dependencies], parameters, functions
+        ))
+    results = await asyncio.gather(*[futures[target] for target in plan.targets])
+    results = dict(zip(plan.targets, results))
 
     # Include execution history in output if operating in development settings
     if learning_observer.settings.RUN_MODE == learning_observer.settings.RUN_MODES.DEV:
-        return {e: _clean_json_via_generator(await visit(e)) for e in target_nodes}
+        return {e: _clean_json_via_generator(result) for e, result in results.items()}
 
     # HACK currently `dashboard.py` relies on the provenance to tell users which
     # items need updating, such as John Doe's history essay. This ought to be
     # handled by the communication protocol during execution. Once that occurs,
     # we can go back to stripping the provenance out.
-    return {e: _clean_json_via_generator(await visit(e)) for e in target_nodes}
+    return {e: _clean_json_via_generator(result) for e, result in results.items()}
     # TODO test this code to make sure it works with async generators
     # Remove execution history if in deployed settings, with data flowing back to teacher dashboards
-    return {e: _clean_json_via_generator(strip_provenance(await visit(e))) for e in target_nodes}
+    return {e: _clean_json_via_generator(strip_provenance(result)) for e, result in results.items()}
+
+
+async def execute_dag(endpoint, parameters, functions, target_exports):
+    """
+    This is the primary way to execute a DAG.
+    Users should pass the overall execution dag dict, a dictionary parameters,
+    a dictionary of available functions, and a list of exports they wish to
+    receive data back for.
+
+    This compiles the DAG each time. If you're running the same DAG
+    over and over, `compile_plan` it once and use `execute_plan`.
+
+    See `learning_observer/communication_protocol/test_cases.py` for usage examples.
+    """
+    return await execute_plan(compile_plan(endpoint, target_exports), parameters, functions)
 
 
 if __name__ == "__main__":
@@ -4,10 +4,7 @@ Learning Observer platform and publishing functions from
 the Learning Observer platform into the communications
 protocol.
 '''
-import copy
-
 import learning_observer.communication_protocol.executor
-import learning_observer.communication_protocol.util
 
 FUNCTIONS = {}
 DUPLICATE_FUNCTION_FOUND = """Duplicate function name found: {name}.
@@ -59,9 +56,15 @@ def add_exports_to_module(execution_dag, module):
     '''
     for query_name in execution_dag['exports']:
         def set_query_with_name(name):
+            plan = None
+
             async def query_func(**kwargs):  # create new function
-                flat = learning_observer.communication_protocol.util.flatten(copy.deepcopy(execution_dag))
-                output = await learning_observer.communication_protocol.executor.execute_dag(flat, parameters=kwargs, functions=FUNCTIONS, target_exports=[query_name])
+                # Compiled on first use, rather than at import, so a
+                # broken export doesn't stop the module from loading
+                nonlocal plan
+                if plan is None:
+                    plan = learning_observer.communication_protocol.executor.compile_plan(execution_dag, [name])
+                output = await learning_observer.communication_protocol.executor.execute_plan(plan, parameters=kwargs, functions=FUNCTIONS)
                 return output
             if hasattr(module, name):
                 raise AttributeError(f'Attibute, {name}, already exists under {module}')
@@ -73,15 +76,17 @@ def add_exports_to_module(execution_dag, module):
 def prepare_dag_execution(query, targets):
     '''
     This functions wraps an execution DAG in the necessary steps to
-    execute specific `targets`.
+    execute specific `targets`. The DAG is compiled once, here, so
+    calling the result just runs it.
 
     Example Usage:
         query_obj = ...  # create the query object
         query_function = prepare_dag_execution(query_obj)
         result = await query_function(param1=value1, param2=value2)
     '''
+    plan = learning_observer.communication_protocol.executor.compile_plan(query, targets)
+
     async def query_func(**kwargs):
-        flat = learning_observer.communication_protocol.util.flatten(copy.deepcopy(query))
-        output = await learning_observer.communication_protocol.executor.execute_dag(flat, parameters=kwargs, functions=FUNCTIONS, target_exports=targets)
+        output = await learning_observer.communication_protocol.executor.execute_plan(plan, parameters=kwargs, functions=FUNCTIONS)
         return output
     return query_func
@@ -31,12 +31,14 @@ import learning_observer.runtime
 import learning_observer.paths as paths
 
 import learning_observer.auth
+import learning_observer.change_notifications
 import learning_observer.constants as constants
 import learning_observer.rosters as rosters
 
 from learning_observer.log_event import debug_log
 
 import learning_observer.module_loader
+import learning_observer.communication_protocol.executor
 import learning_observer.communication_protocol.integration
 import learning_observer.communication_protocol.query
 import learning_observer.communication_protocol.schema
@@ -51,6 +53,23 @@ pmss.register_field(
                 'be used in production.',
     default=False
 )
+pmss.register_field(
+    name='dashboard_resync_seconds',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='With change notifications on, dashboard queries only rerun '\
+                'when data they read changes. We also rerun them in full this '\
+                'often, in case we missed a notification or e.g. a roster changed.',
+    default=300
+)
+pmss.register_field(
+    name='dashboard_websocket_resync_seconds',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='Dashboard websockets only send what has changed since the '\
+                'last update. This often, we forget what we have sent, so '\
+                'the next update for each path is sent in full, overwriting '\
+                'anything the client has gotten wrong.',
+    default=300
+)
 
 
 def timelist_to_seconds(timelist):
@@ -496,6 +515,8 @@ async def _handle_dependent_dags(query):
         debug_log(await dag_not_found(missing_dags))
         return
 
+    # Named queries are shared, so we don't modify them in place
+    query = dict(query)
     for dep in dependent_dags:
         # Copy and qualify names for dependent DAG
         dep_dag = copy.deepcopy(execution_dags[dep]['execution_dag'])
@@ -507,22 +528,61 @@ async def _handle_dependent_dags(query):
     return query
 
 
-async def _prepare_dag_as_generator(client_query, query, target, request):
+# (DAG name, target) -> (the named DAGs it was built from, compiled plan).
+# Named DAGs only change when modules are (re)loaded, so we compile
+# them once, rather than every time a dashboard reruns its query.
+DAG_PLANS = {}
+
+
+async def _compile_dag(query, target):
     '''
-    Prepares the query for execution, sets up client parameters and runtime.
+    Merge in dependent DAGs, and compile the result for `target`.
+    Returns `None` if there's something wrong with the DAG.
     '''
-    target_exports = [target]
+    query = await _handle_dependent_dags(query)
+    if query is None:
+        return None
+    return learning_observer.communication_protocol.executor.compile_plan(query, [target])
 
-    # Prepare the DAG execution function
-    query_func = learning_observer.communication_protocol.integration.prepare_dag_execution(query, target_exports)
 
+async def _named_dag_plan(dag_name, target):
+    '''
+    The compiled plan for a named DAG, from `DAG_PLANS` if the DAG
+    and the DAGs it depends on are still the ones it was compiled from.
+    '''
+    execution_dags = learning_observer.module_loader.execution_dags()
+    cached = DAG_PLANS.get((dag_name, target))
+    if cached is not None:
+        sources, plan = cached
+        if all(execution_dags.get(name) is source for name, source in sources):
+            return plan
+
+    query = await dispatch_named_execution_dag(dag_name)
+    if query is None:
+        return None
+    plan = await _compile_dag(query, target)
+    if plan is None:
+        return None
+    names = {dag_name} | extract_namespaced_dags(query['execution_dag'])
+    DAG_PLANS[(dag_name, target)] = (tuple((name, execution_dags[name]) for name in names), plan)
+    return plan
+
+
+async def _prepare_dag_as_generator(client_query, plan, request):
+    '''
+    Sets up client parameters and runtime, and runs the plan.
+    '''
     # Handle client parameters and runtime setup
     client_parameters = client_query.get('kwargs', {}).copy()
     runtime = learning_observer.runtime.Runtime(request)
     client_parameters['runtime'] = runtime
 
     # Execute the query and return the first value from the generator
-    generator_dictionary = await query_func(**client_parameters)
+    generator_dictionary = await learning_observer.communication_protocol.executor.execute_plan(
+        plan,
+        parameters=client_parameters,
+        functions=learning_observer.communication_protocol.integration.FUNCTIONS
+    )
     return next(iter(generator_dictionary.values()))
 
 
@@ -532,13 +592,18 @@ async def _create_dag_generator(client_query, target, request):
         debug_log(await dag_unsupported_type(type(dag)))
         return
 
-    query = await DAG_DISPATCH[type(dag)](dag)
-    if query is None:
+    if isinstance(dag, str):
+        plan = await _named_dag_plan(dag, target)
+    else:
+        # Submitted DAGs are (in principle) different each time, so we
+        # don't cache them
+        query = await DAG_DISPATCH[type(dag)](dag)
+        plan = None if query is None else await _compile_dag(query, target)
+    if plan is None:
         # the DAG_DISPATCH prints a more detailed message about why
         debug_log('The submitted query failed.')
         return
-    query = await _handle_dependent_dags(query)
-    return await _prepare_dag_as_generator(client_query, query, target, request)
+    return await _prepare_dag_as_generator(client_query, plan, request)
 
 
 def _find_student_or_resource(d):
@@ -570,6 +635,242 @@ def _find_student_or_resource(d):
     return []
 
 
+def _delta(previous, value):
+    '''
+    What to send for a path, given we last sent `previous` for it and
+    now have `value`. Returns `None` if nothing has changed.
+
+    Clients shallow-merge updates into what they have, so we only send
+    the top-level fields which changed:
+
+    >>> _delta(None, {'text': 'abc', 'nlp': 1})
+    {'text': 'abc', 'nlp': 1}
+    >>> _delta({'text': 'abc', 'nlp': 1}, {'text': 'abc', 'nlp': 2})
+    {'nlp': 2}
+    >>> _delta({'text': 'abc'}, {'text': 'abc'}) is None
+    True
+
+    If it's an error, we send the whole thing, since clients look at
+    the whole value to see if it's an error:
+
+    >>> _delta({'text': 'abc'}, {'error': 'oops', 'option_hash': 'x'})
+    {'error': 'oops', 'option_hash': 'x'}
+
+    A merge can't remove fields, so clients hang on to fields which go
+    away (as they did when we sent everything), and if that's the only
+    change, there's nothing to send:
+
+    >>> _delta({'text': 'abc', 'nlp': 1}, {'text': 'abc'}) is None
+    True
+    '''
+    if previous == value:
+        return None
+    if not isinstance(previous, dict) or not isinstance(value, dict) or 'error' in value:
+        return value
+    changed = {k: v for k, v in value.items() if k not in previous or previous[k] != v}
+    return changed or None
+
+
+# Dashboard queries which are running, shared by all of the websockets
+# which asked for the same thing. See `_subscribe`.
+SUBSCRIPTIONS = {}
+
+
+async def _may_share(request, dag_query):
+    '''
+    Shared queries run as one of their subscribers (e.g. with their
+    roster), so we only share a course's results with teachers of that
+    course. We check each subscriber before they join. Anything else
+    (no course, or we can't tell) is only shared between websockets of
+    the same user, e.g. several open tabs.
+    '''
+    course_id = dag_query.get('kwargs', {}).get('course_id')
+    if course_id is None:
+        return False
+    try:
+        courses = await rosters.courselist(request)
+    except Exception as e:
+        debug_log("Could not check course list, so not sharing query:", e)
+        return False
+    return any(str(course.get('id')) == str(course_id) for course in courses)
+
+
+def _subscription_key(dag_query, target, request, shared):
+    '''
+    Queries are the same if they're for the same DAG, export, and
+    parameters. Unless `shared`, they're also per-user.
+    '''
+    user = None
+    if not shared:
+        user = (request.get(constants.USER) or {}).get(constants.USER_ID)
+    return (
+        json.dumps(dag_query.get('execution_dag'), sort_keys=True, default=str),
+        target,
+        json.dumps(dag_query.get('kwargs', {}), sort_keys=True, default=str),
+        user
+    )
+
+
+def _update_student(update_path):
+    '''
+    The student an update is for, or `None` for updates which aren't
+    about one student.
+
+    >>> _update_student('s1.documents.d1')
+    's1'
+    >>> _update_student('') is None
+    True
+    '''
+    return update_path.split('.')[0] or None
+
+
+async def _run_subscription(subscription, dag_query, target):
+    '''
+    Run a query and send each update to everyone subscribed.
+
+    Without change notifications, we rerun every `rerun_dag_delay`
+    seconds. With them, we rerun when a key we read last time changes,
+    and only for the students whose keys changed: `select` skips the
+    rest, and we only send their updates. If a query has updates which
+    aren't about one student (e.g. class summaries), those could
+    depend on anyone, so we rerun in full. Every
+    `dashboard_resync_seconds`, we rerun in full regardless.
+
+    A negative `rerun_dag_delay` means we run once. If a run fails, we
+    log it and carry on as if it had finished (with a full rerun next
+    time), so one bad run doesn't stop the query for everyone.
+    '''
+    dag_kwargs = dag_query.get('kwargs', {})
+    dag_delay = dag_kwargs.get('rerun_dag_delay', 10)
+    push = learning_observer.change_notifications.enabled()
+    resync = learning_observer.settings.pmss_settings.dashboard_resync_seconds(types=['dashboard'])
+    keys = set()  # KVS keys the query read
+    changed_students = set()
+    wake = asyncio.Event()
+    per_student = True
+
+    def on_change(changed_keys):
+        changed_keys = changed_keys & keys
+        if changed_keys:
+            changed_students.update(
+                learning_observer.communication_protocol.executor.key_student(key) for key in changed_keys
+            )
+            wake.set()
+
+    if push:
+        learning_observer.change_notifications.listen(on_change)
+    try:
+        students = None  # which students to rerun for; `None` for everyone
+        last_full_run = time.monotonic()
+        while subscription['subscribers']:
+            # We run as whoever has been subscribed longest
+            request = next(iter(subscription['subscribers'].values()))['request']
+            selected_keys = set()
+            learning_observer.communication_protocol.executor.SELECTED_KEYS.set(selected_keys)
+            learning_observer.communication_protocol.executor.SELECT_STUDENTS.set(students)
+            failed = False
+            try:
+                generator = await _create_dag_generator(dag_query, target, request)
+                if generator is not None:
+                    async for item in generator:
+                        scope = _find_student_or_resource(item)
+                        update_path = ".".join(scope)
+                        student = _update_student(update_path)
+                        if student is None:
+                            per_student = False
+                        if students is not None and student not in students:
+                            continue
+                        if 'option_hash' in dag_kwargs:
+                            item['option_hash'] = dag_kwargs['option_hash']
+                        update = {'op': 'update', 'path': update_path, 'value': item}
+                        subscription['latest'][update_path] = update
+                        for subscriber in list(subscription['subscribers'].values()):
+                            try:
+                                await subscriber['send'](update)
+                            except Exception as e:
+                                # e.g. their websocket closed; they'll unsubscribe
+                                debug_log("Could not send dashboard update:", e)
+            except Exception as e:
+                debug_log("Error running dashboard query:", e)
+                failed = True
+            if students is None:
+                keys.clear()
+            keys.update(selected_keys)
+
+            # Handle rescheduling the execution of the DAG for fresh data
+            if dag_delay < 0:
+                # if dag_delay is negative, we skip repeated execution
+                return
+            if not push:
+                await asyncio.sleep(dag_delay)
+                continue
+            try:
+                await asyncio.wait_for(wake.wait(), timeout=max(0, last_full_run + resync - time.monotonic()))
+                # A changed key which isn't any one student's (`None`)
+                # could feed into anyone's results
+                full = failed or not per_student or None in changed_students
+                students = None if full else set(changed_students)
+            except asyncio.TimeoutError:
+                students = None
+            wake.clear()
+            changed_students.clear()
+            if students is None:
+                last_full_run = time.monotonic()
+    finally:
+        if push:
+            learning_observer.change_notifications.unlisten(on_change)
+
+
+async def _subscribe(subscriber, request, send, dag_query, target, shared):
+    '''
+    Subscribe to a query, starting it if nobody else has. `send` is
+    called with each update. New subscribers to a running query get
+    the latest update for each path straight away, rather than waiting
+    for the next run.
+
+    Queries which have stopped (one-shot queries which have run, or
+    ones which died) are dropped once they stop, so anyone joining
+    after that starts a fresh run, rather than getting stale results.
+
+    Returns the key, for `_unsubscribe`.
+    '''
+    key = _subscription_key(dag_query, target, request, shared)
+    subscription = SUBSCRIPTIONS.get(key)
+    if subscription is None or subscription['task'].done():
+        subscription = {'subscribers': {}, 'latest': {}, 'task': None}
+        SUBSCRIPTIONS[key] = subscription
+        subscription['subscribers'][subscriber] = {'request': request, 'send': send}
+        subscription['task'] = asyncio.create_task(
+            _run_subscription(subscription, copy.deepcopy(dag_query), target)
+        )
+
+        def finished(task):
+            if SUBSCRIPTIONS.get(key) is subscription:
+                del SUBSCRIPTIONS[key]
+            if not task.cancelled() and task.exception() is not None:
+                debug_log("Dashboard query stopped:", task.exception())
+
+        subscription['task'].add_done_callback(finished)
+        return key
+    subscription['subscribers'][subscriber] = {'request': request, 'send': send}
+    for update in list(subscription['latest'].values()):
+        await send(update)
+    return key
+
+
+def _unsubscribe(key, subscriber):
+    '''
+    Leave a query, and stop it if we were the last one there.
+    '''
+    subscription = SUBSCRIPTIONS.get(key)
+    if subscription is None or subscriber not in subscription['subscribers']:
+        return
+    subscription['subscribers'].pop(subscriber, None)
+    if not subscription['subscribers']:
+        subscription['task'].cancel()
+        del SUBSCRIPTIONS[key]
+
+
 @learning_observer.auth.teacher
 async def websocket_dashboard_handler(request):
     '''
@@ -588,19 +889,34 @@ async def websocket_dashboard_handler(request):
     previous_client_query = None
     batch = []
     lock = asyncio.Lock()
+    sent = {}  # path -> the value the client should have for it
 
     async def _send_update(update):
-        '''Send an update to our batch
+        '''Add an update to our batch, if it's changed since we last
+        sent that path (and then, only what has changed).
         '''
         async with lock:
-            batch.append(update)
+            path = update['path']
+            delta = _delta(sent.get(path), update['value'])
+            if delta is None:
+                return
+            sent[path] = update['value']
+            batch.append({**update, 'value': delta})
 
     async def _batch_send():
         '''If our batch has any items, send them to the client
-        then wait before checking again.
+        then wait before checking again. Every so often, we clear
+        `sent`, so the next update for each path goes out in full
+        (as a plain `update`, which overwrites every field the client
+        has for it).
         '''
+        resync_seconds = learning_observer.settings.pmss_settings.dashboard_websocket_resync_seconds(types=['dashboard'])
+        last_resync = time.monotonic()
         while True:
             async with lock:
+                if time.monotonic() - last_resync > resync_seconds:
+                    last_resync = time.monotonic()
+                    sent.clear()
                 if batch:
                     try:
                         await ws.send_json(batch)
@@ -614,69 +930,46 @@ async def websocket_dashboard_handler(request):
             # TODO this ought to be pulled from somewhere
             await asyncio.sleep(1)
 
-    async def _execute_dag(dag_query, target, params):
-        '''This method creates the DAG generator and drives it.
-        Once finished, we wait until rescheduling it. If the parameters
-        change, we exit before creating and driving the generator.
-        '''
-        if params != client_query:
-            # the params are different and we should stop this generator
-            return
-
-        # Create DAG generator and drive
-        generator = await _create_dag_generator(dag_query, target, request)
-        await _drive_generator(generator, dag_query['kwargs'])
-
-        # Handle rescheduling the execution of the DAG for fresh data
-        dag_delay = dag_query['kwargs'].get('rerun_dag_delay', 10)
-        if dag_delay < 0:
-            # if dag_delay is negative, we skip repeated execution
-            return
-        await asyncio.sleep(dag_delay)
-        await _execute_dag(dag_query, target, params)
-
-    async def _drive_generator(generator, dag_kwargs):
-        '''For each item in the generator, this method creates
-        an update to send to the client.
-        '''
-        async for item in generator:
-            scope = _find_student_or_resource(item)
-            update_path = ".".join(scope)
-            if 'option_hash' in dag_kwargs:
-                item['option_hash'] = dag_kwargs['option_hash']
-            await _send_update({'op': 'update', 'path': update_path, 'value': item})
-
     send_batches = asyncio.create_task(_batch_send())
+    subscriptions = []
 
-    while True:
-        try:
-            received_params = await ws.receive_json()
-            client_query = received_params
-            # TODO we should validate the client_query structure
-        except (TypeError, ValueError):
-            # these Errors may signal a close
-            if (await ws.receive()).type == aiohttp.WSMsgType.CLOSE:
-                debug_log("Socket closed!")
+    try:
+        while True:
+            try:
+                received_params = await ws.receive_json()
+                client_query = received_params
+                # TODO we should validate the client_query structure
+            except (TypeError, ValueError):
+                # these Errors may signal a close
+                if (await ws.receive()).type == aiohttp.WSMsgType.CLOSE:
+                    debug_log("Socket closed!")
+                    return aiohttp.web.Response()
+            except asyncio.exceptions.TimeoutError:
+                # this is the normal path of the code
+                # if the client_query hasn't been set, keep waiting for it
+                if client_query is None:
+                    continue
+
+            if ws.closed:
+                debug_log("Socket closed.")
                 return aiohttp.web.Response()
-        except asyncio.exceptions.TimeoutError:
-            # this is the normal path of the code
-            # if the client_query hasn't been set, keep waiting for it
-            if client_query is None:
-                continue
 
-        if ws.closed:
-            debug_log("Socket closed.")
-            return aiohttp.web.Response()
-
-        if client_query != previous_client_query:
-            previous_client_query = copy.deepcopy(client_query)
-            # HACK even though we can specificy multiple targets for a
-            # single DAG, this creates a new DAG for each. This eventually
-            # allows us to specify different parameters (such as the
-            # reschedule timeout).
-            for k, v in client_query.items():
-                for target in v.get('target_exports', []):
-                    asyncio.create_task(_execute_dag(v, target, client_query))
+            if client_query != previous_client_query:
+                previous_client_query = copy.deepcopy(client_query)
+                for key in subscriptions:
+                    _unsubscribe(key, ws)
+                subscriptions = []
+                # HACK even though we can specificy multiple targets for a
+                # single DAG, this creates a new DAG for each. This eventually
+                # allows us to specify different parameters (such as the
+                # reschedule timeout).
+                for k, v in client_query.items():
+                    shared = await _may_share(request, v)
+                    for target in v.get('target_exports', []):
+                        subscriptions.append(await _subscribe(ws, request, _send_update, v, target, shared))
+    finally:
+        for key in subscriptions:
+            _unsubscribe(key, ws)
 
 
 # Obsolete code -- we should put this back in after our refactor. Allows us to use
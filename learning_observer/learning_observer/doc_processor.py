@@ -171,6 +171,9 @@ async def start():
         return {learning_observer.constants.USER: {learning_observer.constants.USER_ID: '12345'}}
 
     aiohttp_session.get_session = get_session
+    # Index any documents written before the key index existed. This is a
+    # single scan on startup; afterwards, the reducers keep it up-to-date.
+    await sa_helpers.rebuild_key_index(KVS)
     await process_documents_with_wait()
 
 
@@ -178,17 +181,11 @@ async def fetch_all_docs():
     '''Return a set of all doc ids currently available
     within the kvs.
     '''
-    doc_ids = set()
-    keys = await KVS.keys()
-    doc_specifier = 'EventField.doc_id:'
-    for k in keys:
-        if doc_specifier not in k: continue
-        end_of_specifier = k.find(doc_specifier) + len(doc_specifier)
-        end_of_id = k.find(',', end_of_specifier)
-        doc_id = k[end_of_specifier : end_of_id if end_of_id != -1 else len(k)]
-        if doc_id == 'None': continue
-        doc_ids.add(doc_id)
-    return doc_ids
+    # Every document we can process has time on task information (see
+    # `check_recent_mod_and_not_recent_process`), so we read the documents
+    # out of that reducer's index.
+    return set(await sa_helpers.documents_for_reducer(
+        writing_observer.writing_analysis.time_on_task, KVS))
 
 
 async def delay_fetch_all_docs(delay=20):
@@ -277,24 +274,20 @@ async def process_document(doc_id):
 
 
 async def _determine_student(doc_id):
-    keys = await KVS.keys()
-    matching_keys = [k for k in keys if doc_id in k]
-    student_specifier = 'STUDENT:'
-    students = [k[k.find(student_specifier) + len(student_specifier):] for k in matching_keys]
+    students = await sa_helpers.students_for_document(doc_id, KVS)
+    if len(students) == 0:
+        raise KeyError(f'No student found for document {doc_id}')
     # TODO handle more than 1 student per document, but for now just grab the first
-    student = students[0]
-    return student
+    return students[0]
 
 
 async def _fetch_teacher_credentials(student):
     '''Determine which teacher a document belongs to
     and return the teacher's stored Google auth info
     '''
-    keys = await KVS.keys()
     roster_specifier = 'learning_observer.google.roster'
-    rosters = [k for k in keys if roster_specifier in k]
     matching_teachers = []
-    for roster_key in rosters:
+    async for roster_key in KVS.iter_keys(pattern=f'*{roster_specifier}*'):
         roster = await KVS[roster_key]
         if student in roster['students']:
             matching_teachers.append(roster['teacher_id'])
@@ -11,7 +11,6 @@ We:
 
 import asyncio
 import datetime
-import inspect
 import json
 import os
 import time
@@ -31,7 +30,7 @@ import learning_observer.settings as settings
 
 import learning_observer.stream_analytics.helpers
 
-from learning_observer.log_event import debug_log
+from learning_observer.log_event import debug_log, debug_log_enabled
 
 import learning_observer.exceptions
 
@@ -57,13 +56,43 @@ def compile_server_data(request):
     }
 
 
-async def student_event_pipeline(metadata):
+def log_reducer_exception(parsed_message, exception):
+    '''
+    A reducer failed on `parsed_message`. We print the traceback, and
+    save the event with the traceback to a critical error file, so we
+    can debug (and replay) it later.
+    '''
+    tb = "".join(traceback.format_exception(type(exception), exception, exception.__traceback__))
+    print(tb)
+    filename = paths.logs("critical-error-{ts}-{rnd}.tb".format(
+        ts=datetime.datetime.now().isoformat(),
+        rnd=uuid.uuid4().hex
+    ))
+    with open(filename, "w") as fp:
+        fp.write(json.dumps(parsed_message, sort_keys=True, indent=2))
+        fp.write("\nTraceback:\n")
+        fp.write(tb)
+
+
+async def student_event_pipeline(metadata, analytics_modules=None):
     '''
     Create an event pipeline, based on header metadata
+
+    By default, events go through all of the reducers for the source.
+    We can pass in `analytics_modules` (`ReducerSpec`s) to run just
+    those instead, e.g. to backfill a new reducer from logs.
     '''
     client_source = None
+    reducers_for_event = stream_analytics.reducers_for_event
 
-    if "source" not in metadata:
+    if analytics_modules is not None:
+        client_source = metadata.get("source")
+        dispatch = stream_analytics.build_event_dispatch(analytics_modules)
+
+        def _reducers_for_event(source, event_type):
+            return dispatch['events'].get(event_type, dispatch['default'])
+        reducers_for_event = _reducers_for_event
+    elif "source" not in metadata:
         analytics_modules = []
         debug_log("Missing client source!")
         print("We are missing a client source. This should never happen. It can mean a few things:")
@@ -78,33 +107,16 @@ async def student_event_pipeline(metadata):
     else:
         client_source = metadata["source"]
         debug_log("client_source", client_source)
-        debug_log("Module", stream_analytics.reducer_modules(client_source))
         analytics_modules = stream_analytics.reducer_modules(client_source)
+        debug_log("Module", analytics_modules)
 
-    # Create an event processor for this user
-    # TODO:
-    # * Thing like this (esp. below) should happen in parallel:
-    #   https://stackoverflow.com/questions/57263090/async-list-comprehensions-in-python
-    # * We should create cached modules for each key, rather than this partial evaluation
-    #   kludge
-    async def prepare_reducer(analytics_module):
-        '''
-        Prepare a reducer for the analytics module. Note that this is in-place (the
-        field is mutated).
-        '''
-        f = analytics_module['reducer']
-        # We're moving to this always being a co-routine. This is
-        # backwards-compatibility code which should be remove,
-        # eventually. We started with a function, and had an interrim
-        # period where both functions and co-routines worked.
-        if not inspect.iscoroutinefunction(f):
-            debug_log("Not a coroutine", analytics_module)
-            raise AttributeError("The reducer {} should be a co-routine".format(analytics_module))
-
-        analytics_module['reducer_partial'] = await analytics_module['reducer'](metadata)
-        return analytics_module
-
-    analytics_modules = await asyncio.gather(*[prepare_reducer(am) for am in analytics_modules])
+    # Create an event processor for this user. The reducer specs are
+    # compiled once, in `stream_analytics.init()`, and shared between
+    # connections. All we do per connection is bind each reducer to
+    # the connection metadata.
+    reducer_partials = await asyncio.gather(*[
+        analytics_module.reducer(metadata) for analytics_module in analytics_modules
+    ])
 
     async def pipeline(parsed_message):
         '''
@@ -119,47 +131,67 @@ async def student_event_pipeline(metadata):
         if 'event' not in parsed_message['client']:
             raise ValueError("Expected a dict with a 'client' field with an 'event' field")
 
-        debug_log("Processing message {event} from {source}".format(
-            event=parsed_message["client"]["event"], source=client_source
-        ))
-
-        # Try to run a message through all event processors.
-        #
-        # To do: Finer-grained exception handling. Right now, if we break, we
-        # don't even run through the remaining processors.
-        try:
-            processed_analytics = []
-            # Go through all the analytics modules
-            for am in analytics_modules:
-                debug_log("Scope", am['scope'])
-                event_fields = {}
-                skip = False
-                for field in am['scope']:
-                    if isinstance(field, learning_observer.stream_analytics.helpers.EventField):
-                        debug_log("event", parsed_message)
-                        debug_log("field", field)
-                        client_event = parsed_message.get('client', {})
-                        if field.event not in client_event:
-                            debug_log(field.event, "not found")
-                            skip = True
-                        event_fields[field.event] = client_event.get(field.event)
-                if not skip:
-                    debug_log("args", event_fields)
-                    processed_analytics.append(await am['reducer_partial'](parsed_message, event_fields))
-        except Exception as e:
-            traceback.print_exc()
-            filename = paths.logs("critical-error-{ts}-{rnd}.tb".format(
-                ts=datetime.datetime.now().isoformat(),
-                rnd=uuid.uuid4().hex
+        client_event = parsed_message['client']
+        # This is called for every event, so we skip building debug
+        # messages unless we're going to print them.
+        debug = debug_log_enabled()
+        if debug:
+            debug_log("Processing message {event} from {source}".format(
+                event=client_event["event"], source=client_source
             ))
-            fp = open(filename, "w")
-            fp.write(json.dumps(parsed_message, sort_keys=True, indent=2))
-            fp.write("\nTraceback:\n")
-            fp.write(traceback.format_exc())
-            fp.close()
-            if settings.RUN_MODE == settings.RUN_MODES.DEV:
-                raise
+
+        # Run the message through all event processors. Each reducer
+        # works on its own keys, so we run them concurrently; per-event
+        # latency is then roughly that of the slowest reducer, rather
+        # than the sum of all of them.
+        reducer_calls = []
+        # Only go through the analytics modules which care about this
+        # type of event
+        indexes = None
+        if analytics_modules:
+            indexes = reducers_for_event(client_source, client_event['event'])
+        if indexes is None:
+            indexes = range(len(analytics_modules))
+        for i in indexes:
+            am = analytics_modules[i]
+            if debug:
+                debug_log("Scope", am.scope)
+            missing = [field for field in am.event_fields if field not in client_event]
+            if missing:
+                if debug:
+                    debug_log(missing, "not found")
+                continue
+            event_fields = {field: client_event[field] for field in am.event_fields}
+            if debug:
+                debug_log("args", event_fields)
+            reducer_calls.append(reducer_partials[i](parsed_message, event_fields))
+
+        # Failures are isolated per reducer: one crashing reducer doesn't
+        # stop the others from seeing the event.
+        results = await asyncio.gather(*reducer_calls, return_exceptions=True)
+        processed_analytics = []
+        errors = []
+        for result in results:
+            if isinstance(result, Exception):
+                errors.append(result)
+                log_reducer_exception(parsed_message, result)
+            else:
+                processed_analytics.append(result)
+        if errors and settings.RUN_MODE == settings.RUN_MODES.DEV:
+            raise errors[0]
         return processed_analytics
+
+    async def flush():
+        '''
+        Write back any reducer state held in memory (see
+        `reducer_write_back_cache`). Called when the connection closes.
+        '''
+        for reducer_partial in reducer_partials:
+            reducer_flush = getattr(reducer_partial, 'flush', None)
+            if reducer_flush is not None:
+                await reducer_flush()
+
+    pipeline.flush = flush
     return pipeline
 
 COUNTER = 0
@@ -191,22 +223,28 @@ async def handle_incoming_client_event(metadata):
         This is the handler for incoming client events.
         '''
         client_event = adapter.canonicalize_event(client_event)
-        debug_log("Compiling event for reducer: " + client_event["event"])
+        if debug_log_enabled():
+            debug_log("Compiling event for reducer: " + client_event["event"])
         event = {
             "client": client_event,
             "server": compile_server_data(request),
             "metadata": metadata
         }
 
+        # We encode the event once, and write the same bytes everywhere
+        encoded_event = log_event.encode_event(event)
         # Log to the main event log file
-        log_event.log_event(event)
+        log_event.log_event(encoded_event, preencoded=True)
+        log_event.archive_event(event, session=filename, encoded=encoded_event)
         # Log the same thing to our study log file. This isn't a good final format, since we
         # mix data with auth, but we want this for now.
         log_event.log_event(
-            json.dumps(event, sort_keys=True),
+            encoded_event,
             filename, preencoded=True, timestamp=True)
         await pipeline(event)
 
+    handler.flush = pipeline.flush
+
     # when the handler garbage collected (no more events are being passed through),
     # close the log file associated with this connection
     weakref.finalize(handler, log_event.close_logfile, filename)
@@ -253,29 +291,6 @@ def event_decoder_and_logger(
 
     The feature flag has the non-hack implementation.
     '''
-    if merkle_config := settings.feature_flag("merkle"):
-        import merkle_store
-
-        storage_class = merkle_store.STORES[merkle_config['store']]
-        params = merkle_config.get("params", {})
-        if not isinstance(params, dict):
-            raise ValueError("Merkle tree params must be a dict (even an empty one)")
-        storage = storage_class(**params)
-        merkle_store.Merkle(storage)
-        session = {
-            "student": request.student,
-            "tool": request.tool
-        }
-        merkle_store.start(session)
-
-        def decode_and_log_event(msg):
-            '''
-            Decode and store the event in the Merkle tree
-            '''
-            event = json.loads(msg)
-            merkle_store.event_to_session(event)
-            return event
-
     global COUNT
     # Count + PID should guarantee uniqueness.
     # With multi-server installations, we might want to add
@@ -290,20 +305,76 @@ def event_decoder_and_logger(
     )
     COUNT += 1
 
+    # If we don't need the logs canonicalized, we can skip re-encoding
+    # what we just parsed, and log the frame as we received it.
+    log_raw_frames = settings.pmss_settings.log_raw_frames(types=['logging'])
+
+    # The non-hack implementation: we also store events in a Merkle
+    # DAG. We add events in batches, so hashing and storage writes
+    # happen once per batch rather than once per event.
+    merkle = None
+    merkle_batch = []
+    if merkle_config := settings.feature_flag("merkle"):
+        import learning_observer.merkle_store as merkle_store
+
+        storage_class = merkle_store.STORES[merkle_config['store']]
+        params = merkle_config.get("params", {})
+        if not isinstance(params, dict):
+            raise ValueError("Merkle tree params must be a dict (even an empty one)")
+        storage = storage_class(**params)
+        merkle = merkle_store.Merkle(storage, merkle_store.CATEGORIES)
+        merkle_batch_size = merkle_config.get("batch_size", 100)
+        # We don't know who the student is until we've processed the
+        # auth events, so unless told otherwise, each connection is its
+        # own session.
+        merkle_session = session or {"session": [filename]}
+        merkle.start(merkle_session)
+
+    def flush_merkle_batch():
+        '''
+        Add the events we've batched up to the Merkle DAG
+        '''
+        if merkle is not None and merkle_batch:
+            merkle.events_to_session(
+                [event for event, encoded in merkle_batch],
+                merkle_session,
+                encoded=[encoded for event, encoded in merkle_batch]
+            )
+            merkle_batch.clear()
+
     async def decode_and_log_event(events):
         '''
         Take an aiohttp web sockets message, log it, and return
         a clean event.
         '''
-        async for msg in events:
-            if isinstance(msg, dict):
-                json_event = msg
-            else:
-                json_event = json.loads(msg.data)
-            log_event.log_event(json_event, filename=filename)
-            yield json_event
-        # done processing events, can close logfile now
-        log_event.close_logfile(filename)
+        try:
+            async for msg in events:
+                if isinstance(msg, dict):
+                    json_event = msg
+                    raw_frame = None
+                else:
+                    json_event = json.loads(msg.data)
+                    raw_frame = msg.data
+                encoded = None
+                if log_raw_frames and raw_frame is not None:
+                    log_event.log_event(raw_frame, filename=filename, preencoded=True)
+                else:
+                    encoded = log_event.encode_event(json_event)
+                    log_event.log_event(encoded, filename=filename, preencoded=True)
+                if merkle is not None:
+                    merkle_batch.append((json_event, encoded))
+                    if len(merkle_batch) >= merkle_batch_size:
+                        flush_merkle_batch()
+                yield json_event
+        finally:
+            # done processing events (or the connection dropped, or an
+            # event failed), so store what we have, and close the logfile.
+            try:
+                flush_merkle_batch()
+            finally:
+                if merkle is not None:
+                    merkle.storage.close()
+                log_event.close_logfile(filename)
     return decode_and_log_event
 
 
@@ -349,6 +420,14 @@ async def incoming_websocket_handler(request):
         if ws.closed:
             debug_log(f'ws connection closed for reason {ws.close_code}')
 
+    async def flush_event_handler():
+        '''Write back any reducer state the current `event_handler`
+        is holding in memory, before we replace or drop it.
+        '''
+        flush = getattr(event_handler, 'flush', None)
+        if flush is not None:
+            await flush()
+
     async def update_event_handler(event):
         '''We need source and auth ready before we can
         set up the `event_handler` and be ready to process
@@ -364,6 +443,7 @@ async def incoming_websocket_handler(request):
         else:
             metadata = event
         metadata['auth'] = authenticated
+        await flush_event_handler()
         event_handler = await handle_incoming_client_event(metadata=metadata)
         reducers_last_updated = learning_observer.stream_analytics.LAST_UPDATED
         return True
@@ -457,11 +537,17 @@ async def incoming_websocket_handler(request):
                 await update_event_handler(event)
             yield event
 
+    # For load testing, clients can ask us to acknowledge events once
+    # they've been through the reducers, by including an `ack` ID.
+    send_acks = settings.feature_flag('event_acks') is not None
+
     async def pass_through_reducers(events):
         '''Pass events through the reducers
         '''
         async for event in events:
             await event_handler(request, event)
+            if send_acks and 'ack' in event:
+                await ws.send_json({'status': 'ack', 'ack': event['ack']})
             yield event
 
     async def process_ws_message_through_pipeline():
@@ -480,6 +566,9 @@ async def incoming_websocket_handler(request):
         debug_log('We are done passing events through the pipeline.')
 
     # process websocket messages and begin executing events from the queue
-    await process_ws_message_through_pipeline()
+    try:
+        await process_ws_message_through_pipeline()
+    finally:
+        await flush_event_handler()
 
     return ws
@@ -1,8 +1,9 @@
+import learning_observer.backfill
 import learning_observer.communication_protocol.query as q
 import learning_observer.dashboard
-import learning_observer.kvs
 import learning_observer.module_loader
 import learning_observer.stream_analytics
+import learning_observer.stream_analytics.helpers
 from learning_observer.stream_analytics.helpers import KeyField, Scope
 
 MODULE_NAME = 'jupyter-helper'
@@ -46,29 +47,41 @@ def construct_reducer(reducer_id, reducer_func, module=MODULE_NAME, scope=None,
     return reducer
 
 
-async def remove_reducer_results_from_kvs(reducer_id):
-    '''Find all keys that match the reducer and remove them
+async def remove_reducer_results_from_kvs(reducer):
+    '''Find all keys written by the reducer and remove them
 
-    TODO: Figure out if we should move this into kvs.py or otherwise bubble
-    it up. It seems like it may be more broadly applicable than just
-    interactive development.
+    Keys are named after the reducer's function (e.g.
+    `Internal,testing.event_counter,...`), not its `id`, so we go by
+    the function. See `helpers.remove_reducer_keys`.
     '''
-    kvs = learning_observer.kvs.KVS()
-    keys = await kvs.keys()
-    matched_keys = [k for k in keys if reducer_id in k]
-    for m in matched_keys:
-        await kvs.remove(m)
+    return await learning_observer.stream_analytics.helpers.remove_reducer_keys(reducer['function'])
 
 
 async def _restream_prior_event_logs(reducer):
     '''Process event logs through a reducer in the background while
     keeping the old reducer running. Once finished, swap active
     reducers in the event pipeline.
+
+    See `learning_observer.backfill`. Checkpoints are kept in the KVS,
+    so calling this again for a new reducer resumes the backfill.
+
+    A changed reducer would write to the same keys as the old version,
+    so we backfill a `versioned` copy with keys of its own. The old
+    version (and its data) stays live until the swap, and its keys are
+    removed after.
     '''
-    # TODO process reducer over files corresponding to the removed keys
-    # files_to process = find_files(removed_keys)
-    # await learning_observer.offline.process_files(files_to_process)
-    raise NotImplementedError('Restreaming of prior event logs has not yet been implemented')
+    reducer_id = reducer['id']
+    running = next((r for r in learning_observer.module_loader.reducers() if r['id'] == reducer_id), None)
+    if running is None:
+        return learning_observer.backfill.start_backfill(reducer)
+    if not hasattr(reducer['function'], 'versioned'):
+        raise ValueError(
+            f'Cannot restream `{reducer_id}` alongside the running version, since it '
+            'is not a `kvs_pipeline` reducer. Use the `drop_data` migration instead.'
+        )
+    version = (getattr(running['function'], 'version', None) or 0) + 1
+    versioned = dict(reducer, function=reducer['function'].versioned(version))
+    return learning_observer.backfill.start_backfill(versioned, restart=True, replaces=running)
 
 
 async def _drop_prior_data(reducer):
@@ -76,9 +89,11 @@ async def _drop_prior_data(reducer):
     remove any data associated with the removed reducer.
     '''
     reducer_id = reducer['id']
+    # The data is under the running version's keys, if there is one
+    running = next((r for r in learning_observer.module_loader.reducers() if r['id'] == reducer_id), reducer)
     learning_observer.module_loader.remove_reducer(reducer_id)
     learning_observer.stream_analytics.init()
-    await remove_reducer_results_from_kvs(reducer_id)
+    await remove_reducer_results_from_kvs(running)
 
 
 async def _process_curr_reducer_output_through_func(reducer):
@@ -128,9 +143,11 @@ async def hot_load_reducer(reducer, reload=False, migration_function=None):
         # TODO we want to pass more args/kwargs in here for the other migration policies
         await MIGRATION_POLICY[migration_function](reducer)
 
-    # add reducer to available reducers and re-init our pipeline
-    learning_observer.module_loader.add_reducer(reducer)
-    learning_observer.stream_analytics.init()
+    # add reducer to available reducers and re-init our pipeline. When
+    # restreaming, the backfill does this once it has caught up.
+    if migration_function != RESTREAM_PRIOR_DATA:
+        learning_observer.module_loader.add_reducer(reducer)
+        learning_observer.stream_analytics.init()
 
     # TODO determine the best way to update the execution dag
     # much of this is currently hardcoded for Student scope.
@@ -12,12 +12,14 @@ To read objects:
 '''
 
 import asyncio
+import collections
 import copy
 import enum
 import functools
 import json
 import os
 import os.path
+import re
 
 import learning_observer.paths
 import learning_observer.prestartup
@@ -28,6 +30,112 @@ import learning_observer.util
 OBJECT_STORE = dict()
 
 
+# How many keys we ask redis to look at per `SCAN` round trip
+SCAN_COUNT = 1000
+
+# Secondary indexes (sets of keys) live in the same keyspace as
+# everything else, under this prefix. See `_KVS.index_add`.
+INDEX_KEY_PREFIX = 'Index,'
+
+# Counts of KVS operations in this process, for the status page and
+# for load testing. A multiget / multiset is one operation (that's the
+# point), but its keys are added to `keys_read` / `keys_written`.
+OPERATIONS = collections.Counter()
+
+# Index key -> lock, serializing `_KVS.index_add` within this process
+INDEX_LOCKS = collections.defaultdict(asyncio.Lock)
+
+
+def kvs_metrics():
+    '''
+    Returns a dictionary of operation counts, e.g. `{'get': 10,
+    'keys_read': 10, ...}`
+    '''
+    return dict(OPERATIONS)
+
+
+def escape_key_pattern(text):
+    '''
+    Escape a literal string (e.g. a document ID) so it can be embedded
+    in a key pattern for `iter_keys`.
+
+    >>> escape_key_pattern('doc*1?')
+    'doc\\\\*1\\\\?'
+    '''
+    return re.sub(r'([\\*?\[\]])', r'\\\1', text)
+
+
+def key_pattern_to_regex(pattern):
+    '''
+    Translate a redis-style glob (as used by `SCAN MATCH`) into a
+    compiled regular expression, so the non-redis back-ends match
+    exactly the same keys as redis does.
+
+    `*` matches anything, `?` matches one character, `[...]` is a
+    character class (`[^...]` negated), and a backslash escapes the
+    next character.
+
+    >>> bool(key_pattern_to_regex('Internal,*STUDENT:*').match('Internal,a.b,STUDENT:bob'))
+    True
+    >>> bool(key_pattern_to_regex('*' + escape_key_pattern('doc*1') + '*').match('x,doc*1,y'))
+    True
+    >>> bool(key_pattern_to_regex('*' + escape_key_pattern('doc*1') + '*').match('x,doc21,y'))
+    False
+    >>> bool(key_pattern_to_regex('h[^e]llo').match('hallo'))
+    True
+    '''
+    regex = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\' and i + 1 < len(pattern):
+            i += 1
+            regex.append(re.escape(pattern[i]))
+        elif c == '*':
+            regex.append('.*')
+        elif c == '?':
+            regex.append('.')
+        elif c == '[' and ']' in pattern[i + 1:]:
+            end = pattern.index(']', i + 1)
+            body = pattern[i + 1:end]
+            negate = body.startswith('^')
+            if negate:
+                body = body[1:]
+            body = ''.join('\\' + ch if ch in '\\]^[' else ch for ch in body)
+            regex.append('[' + ('^' if negate else '') + body + ']')
+            i = end
+        else:
+            regex.append(re.escape(c))
+        i += 1
+    return re.compile(''.join(regex) + r'\Z', re.DOTALL)
+
+
+def _key_filter(prefix=None, pattern=None):
+    '''
+    Return a predicate for keys, for back-ends where we filter in
+    Python.
+    '''
+    regex = key_pattern_to_regex(pattern) if pattern is not None else None
+
+    def matches(key):
+        if prefix is not None and not key.startswith(prefix):
+            return False
+        if regex is not None and not regex.match(key):
+            return False
+        return True
+    return matches
+
+
+def _kvs_items(items):
+    '''
+    Helper for `multiset`: accept either a dictionary or a list of
+    `(key, value)` pairs, and return a list of pairs.
+    '''
+    if isinstance(items, dict):
+        return list(items.items())
+    return list(items)
+
+
 class _KVS:
     async def dump(self, filename=None):
         '''
@@ -52,7 +160,10 @@ class _KVS:
         '''
         data = {}
         for key in await self.keys():
-            data[key] = await self[key]
+            if key.startswith(INDEX_KEY_PREFIX):
+                data[key] = sorted(await self.index_members(key[len(INDEX_KEY_PREFIX):]))
+            else:
+                data[key] = await self[key]
         if filename:
             with open(filename, 'w') as f:
                 json.dump(data, f, indent=4)
@@ -61,10 +172,52 @@ class _KVS:
     async def multiget(self, keys):
         '''
         Multiget. It's not fast, but it means we can use appropriate
-        abstractions and make it fast later.
+        abstractions. Back-ends which can batch reads (e.g. redis)
+        override this.
+
+        Returns a list of values in the same order as `keys`, with
+        `None` for missing keys.
         '''
         return [await self[key] for key in keys]
 
+    async def multiset(self, items):
+        '''
+        Multiset. `items` is either a dictionary or a list of `(key,
+        value)` pairs. As with `multiget`, back-ends which can batch
+        writes override this.
+        '''
+        for key, value in _kvs_items(items):
+            await self.set(key, value)
+
+    async def exists(self, keys):
+        '''
+        Which of `keys` are in the KVS? Returns a list of booleans, in
+        the same order as `keys`.
+
+        This generic version fetches the values, so it can't tell a key
+        set to `None` from a missing one. Back-ends which can check
+        without reading override this.
+        '''
+        return [value is not None for value in await self.multiget(keys)]
+
+    async def iter_keys(self, prefix=None, pattern=None):
+        '''
+        Asynchronously iterate over keys, optionally only those which
+        start with `prefix` and/or match the redis-style glob
+        `pattern`:
+
+        >> async for key in kvs.iter_keys(prefix='Internal,'):
+        ..     ...
+
+        Prefer this to `keys()`, which returns the whole keyspace as a
+        list. This generic version still calls `keys()`; back-ends
+        override it where they can do better.
+        '''
+        matches = _key_filter(prefix, pattern)
+        for key in await self.keys():
+            if matches(key):
+                yield key
+
     async def load(self, filename):
         '''
         Loads the contents of a JSON object into the KVS.
@@ -76,7 +229,56 @@ class _KVS:
         with open(filename) as f:
             data = json.load(f)
         for key, value in data.items():
-            await self.set(key, value)
+            if key.startswith(INDEX_KEY_PREFIX):
+                for member in value:
+                    await self.index_add([key[len(INDEX_KEY_PREFIX):]], member)
+            else:
+                await self.set(key, value)
+
+    async def index_add(self, indexes, member):
+        '''
+        Add `member` (typically a key) to each of the secondary indexes
+        named in `indexes`. An index is a set of strings, which lets us
+        answer questions like "which keys belong to this document?"
+        without scanning the whole KVS.
+
+        This generic version stores each index as a sorted JSON list,
+        so adding is a read-modify-write, O(N) in the size of the index.
+        Connections run concurrently, so we hold a per-index lock around
+        it. That only covers this process: the filesystem back-end is
+        single-writer (one process) only. Redis overrides this with
+        native sets, which are safe across processes.
+        '''
+        for index in indexes:
+            key = INDEX_KEY_PREFIX + index
+            async with INDEX_LOCKS[key]:
+                members = set(await self[key] or [])
+                if member not in members:
+                    members.add(member)
+                    await self.set(key, sorted(members))
+
+    async def index_remove(self, indexes, member):
+        '''
+        Remove `member` from each of the secondary indexes named in
+        `indexes`, e.g. once its key is gone. Indexes don't expire, so
+        whoever removes (or notices a missing) key should do this. As
+        with `index_add`, this generic version is a locked
+        read-modify-write.
+        '''
+        for index in indexes:
+            key = INDEX_KEY_PREFIX + index
+            async with INDEX_LOCKS[key]:
+                members = set(await self[key] or [])
+                if member in members:
+                    members.remove(member)
+                    await self.set(key, sorted(members))
+
+    async def index_members(self, index):
+        '''
+        Return the set of members of the secondary index `index`. See
+        `index_add`.
+        '''
+        return set(await self[INDEX_KEY_PREFIX + index] or [])
 
 
 class InMemoryKVS(_KVS):
@@ -89,6 +291,8 @@ class InMemoryKVS(_KVS):
 
         >> await kvs['item']
         '''
+        OPERATIONS['get'] += 1
+        OPERATIONS['keys_read'] += 1
         return copy.deepcopy(OBJECT_STORE.get(key, None))
 
     async def set(self, key, value):
@@ -106,8 +310,44 @@ class InMemoryKVS(_KVS):
         '''
         json.dumps(value)  # Fail early if we're not JSON
         assert isinstance(key, str), "KVS keys must be strings"
+        OPERATIONS['set'] += 1
+        OPERATIONS['keys_written'] += 1
         OBJECT_STORE[key] = value
 
+    async def multiget(self, keys):
+        '''
+        Return a list of values for `keys`, without awaiting each one.
+        '''
+        OPERATIONS['multiget'] += 1
+        OPERATIONS['keys_read'] += len(keys)
+        return [copy.deepcopy(OBJECT_STORE.get(key, None)) for key in keys]
+
+    async def exists(self, keys):
+        '''
+        Which of `keys` are in the KVS? See `_KVS.exists`.
+        '''
+        return [key in OBJECT_STORE for key in keys]
+
+    async def remove(self, key):
+        '''
+        Remove an item from the KVS, if it's there.
+        '''
+        OBJECT_STORE.pop(key, None)
+
+    async def multiset(self, items):
+        '''
+        Set many items at once. We validate everything before we write
+        anything, so a bad value doesn't leave us half-written.
+        '''
+        items = _kvs_items(items)
+        for key, value in items:
+            json.dumps(value)  # Fail early if we're not JSON
+            assert isinstance(key, str), "KVS keys must be strings"
+        OPERATIONS['multiset'] += 1
+        OPERATIONS['keys_written'] += len(items)
+        for key, value in items:
+            OBJECT_STORE[key] = value
+
     async def keys(self):
         '''
         Returns all keys.
@@ -116,6 +356,15 @@ class InMemoryKVS(_KVS):
         '''
         return list(OBJECT_STORE.keys())
 
+    async def iter_keys(self, prefix=None, pattern=None):
+        '''
+        Iterate over matching keys. See `_KVS.iter_keys`.
+        '''
+        matches = _key_filter(prefix, pattern)
+        for key in list(OBJECT_STORE):
+            if matches(key):
+                yield key
+
     async def clear(self):
         '''
         Clear the KVS.
@@ -149,6 +398,8 @@ class _RedisKVS(_KVS):
         >> await kvs['item']
         '''
         await self.connect()
+        OPERATIONS['get'] += 1
+        OPERATIONS['keys_read'] += 1
         item = await learning_observer.redis_connection.get(key)
         if item is not None:
             return json.loads(item)
@@ -170,8 +421,35 @@ class _RedisKVS(_KVS):
         await self.connect()
         value = json.dumps(value)  # Fail early if we're not JSON
         assert isinstance(key, str), "KVS keys must be strings"
+        OPERATIONS['set'] += 1
+        OPERATIONS['keys_written'] += 1
         return await learning_observer.redis_connection.set(key, value, expiry=self.expire)
 
+    async def multiget(self, keys):
+        '''
+        Fetch all of `keys` with a single `MGET`, rather than one round
+        trip per key.
+        '''
+        await self.connect()
+        OPERATIONS['multiget'] += 1
+        OPERATIONS['keys_read'] += len(keys)
+        items = await learning_observer.redis_connection.mget(keys)
+        return [json.loads(item) if item is not None else None for item in items]
+
+    async def multiset(self, items):
+        '''
+        Write all of `items` in one pipelined round trip. See
+        `redis_connection.mset`.
+        '''
+        await self.connect()
+        encoded = []
+        for key, value in _kvs_items(items):
+            assert isinstance(key, str), "KVS keys must be strings"
+            encoded.append((key, json.dumps(value)))  # Fail early if we're not JSON
+        OPERATIONS['multiset'] += 1
+        OPERATIONS['keys_written'] += len(encoded)
+        return await learning_observer.redis_connection.mset(encoded, expiry=self.expire)
+
     async def keys(self):
         '''
         Return all the keys in the KVS.
@@ -181,6 +459,54 @@ class _RedisKVS(_KVS):
         await self.connect()
         return await learning_observer.redis_connection.keys()
 
+    async def index_add(self, indexes, member):
+        '''
+        Add `member` to each index with a pipelined `SADD`. See
+        `_KVS.index_add`.
+        '''
+        await self.connect()
+        keys = [INDEX_KEY_PREFIX + index for index in indexes]
+        return await learning_observer.redis_connection.sadd_many(keys, member)
+
+    async def index_remove(self, indexes, member):
+        '''
+        Remove `member` from each index with a pipelined `SREM`. See
+        `_KVS.index_remove`.
+        '''
+        await self.connect()
+        keys = [INDEX_KEY_PREFIX + index for index in indexes]
+        return await learning_observer.redis_connection.srem_many(keys, member)
+
+    async def exists(self, keys):
+        '''
+        Which of `keys` exist, with pipelined `EXISTS`. See `_KVS.exists`.
+        '''
+        await self.connect()
+        return await learning_observer.redis_connection.exists_many(keys)
+
+    async def index_members(self, index):
+        '''
+        Return the members of an index with `SMEMBERS`.
+        '''
+        await self.connect()
+        return await learning_observer.redis_connection.smembers(INDEX_KEY_PREFIX + index)
+
+    async def iter_keys(self, prefix=None, pattern=None):
+        '''
+        Iterate over matching keys with `SCAN MATCH`, so we never block
+        redis or load the whole keyspace. See `_KVS.iter_keys`.
+        '''
+        await self.connect()
+        if pattern is None and prefix is None:
+            match = None
+        elif pattern is None:
+            match = escape_key_pattern(prefix) + '*'
+        else:
+            match = pattern
+        async for key in learning_observer.redis_connection.scan_keys(match=match, count=SCAN_COUNT):
+            if prefix is None or key.startswith(prefix):
+                yield key
+
     async def remove(self, key):
         '''
         Remove item from the KVS.
@@ -255,6 +581,8 @@ class FilesystemKVS(_KVS):
         return learning_observer.util.from_safe_filename(filename)
 
     async def __getitem__(self, key):
+        OPERATIONS['get'] += 1
+        OPERATIONS['keys_read'] += 1
         path = self.key_to_safe_filename(key)
         if not os.path.exists(path):
             return None
@@ -262,6 +590,8 @@ class FilesystemKVS(_KVS):
             return json.load(f)
 
     async def set(self, key, value):
+        OPERATIONS['set'] += 1
+        OPERATIONS['keys_written'] += 1
         path = self.key_to_safe_filename(key)
         if self.subdirs:
             os.makedirs(os.path.dirname(path), exist_ok=True)
@@ -272,6 +602,20 @@ class FilesystemKVS(_KVS):
         path = self.key_to_safe_filename(key)
         os.remove(path)
 
+    async def remove(self, key):
+        '''
+        Remove an item from the KVS, if it's there. See `_RedisKVS.remove`.
+        '''
+        path = self.key_to_safe_filename(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    async def exists(self, keys):
+        '''
+        Which of `keys` have files. See `_KVS.exists`.
+        '''
+        return [os.path.exists(self.key_to_safe_filename(key)) for key in keys]
+
     async def keys(self):
         '''
         This one is a little bit tricky, since if subdirs, we need to do a full
@@ -430,17 +774,29 @@ async def test():
         await fs2.set("foob", "loo")
         await fs2.set("fob/perła", "koo")
         assert (await fs1["fooo"]) == "poof"
-    if False:  # We don't do this correctly yet
-        async for k in fs2.keys():
-            print(k)
-        async for k in fs1.keys():
-            print(k)
+        print([k async for k in fs1.iter_keys(prefix="foo")])
+        print([k async for k in fs2.iter_keys(pattern="fo?b")])
 
     assert (await mk1["hi"]) == 7
+    await mk1.multiset({"multi-a": 1, "multi-b": [2]})
+    assert (await mk2.multiget(["multi-a", "multi-b", "multi-c"])) == [1, [2], None]
+    await ek1.multiset([("multi-a", 3), ("multi-b", {"b": 4})])
+    assert (await ek2.multiget(["multi-a", "multi-b", "multi-c"])) == [3, {"b": 4}, None]
     print(await ek1["hi"])
     print(type(await ek1["hi"]))
     print((await ek1["hi"]) == 9)
     assert (await ek1["hi"]) == 9
+    assert [k async for k in mk1.iter_keys(prefix="multi-")] == ["multi-a", "multi-b"]
+    await mk1.index_add(["idx-1", "idx-2"], "multi-a")
+    await ek1.index_add(["idx-1", "idx-2"], "multi-a")
+    await ek1.index_add(["idx-1"], "multi-b")
+    assert (await mk2.index_members("idx-2")) == {"multi-a"}
+    assert (await ek2.index_members("idx-1")) == {"multi-a", "multi-b"}
+    await ek1.index_remove(["idx-1"], "multi-b")
+    assert (await ek2.index_members("idx-1")) == {"multi-a"}
+    assert (await mk1.exists(["multi-a", "multi-c"])) == [True, False]
+    assert (await ek1.exists(["multi-a", "multi-c"])) == [True, False]
+    assert sorted([k async for k in ek1.iter_keys(pattern="multi-[ab]")]) == ["multi-a", "multi-b"]
     print(await mk1.keys())
     print(await ek1.keys())
     print("Test successful")
@@ -48,16 +48,28 @@ were, but we might not keep terabytes of data around (just enough to
 redo those analyses).
 '''
 
+import atexit
+import collections
 import datetime
 from enum import Enum
+import gzip
 import inspect
 import io
 import json
 import hashlib
 import os
 import os.path
+import queue
+import threading
+import time
+import traceback
 import pmss
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 import learning_observer.constants
 import learning_observer.filesystem_state
 
@@ -81,9 +93,115 @@ if not os.path.exists(paths.logs("startup")):
     os.mkdir(paths.logs("startup"))
 
 mainlog = open(paths.logs("main_log.json"), "ab", 0)
-files = {}
 startup_state = {}
 
+# Background writer for event logs, if enabled (see `LogWriter`)
+LOG_WRITER = None
+# Compressed event archive, if enabled (see `EventArchive`)
+ARCHIVE = None
+# Encode events with `orjson`, if enabled (see `encode_event`)
+ORJSON_ENCODING = False
+
+pmss.register_field(
+    name='orjson_event_encoding',
+    type=pmss.pmsstypes.TYPES.boolean,
+    description='Encode events for the logs with `orjson`, which is much faster '\
+                'than `json`. This needs the `orjson` package. Note that `orjson` '\
+                'output is more compact (no spaces), so log lines and hashes differ '\
+                'from those written with `json`.',
+    default=False
+)
+pmss.register_field(
+    name='log_raw_frames',
+    type=pmss.pmsstypes.TYPES.boolean,
+    description='Write websocket frames to the per-session logs verbatim, rather '\
+                'than parsing and re-encoding them. This is faster, but the logs '\
+                'are then only as canonical as what the client sent.',
+    default=False
+)
+
+pmss.register_field(
+    name='max_open_log_files',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='The most per-session log files we keep open at once. Beyond '\
+                'this, we close the least recently used file, and reopen it '\
+                '(in append mode) if the session sends more events. This should '\
+                'be comfortably below `ulimit -n`.',
+    default=256
+)
+pmss.register_field(
+    name='event_archive',
+    type=pmss.pmsstypes.TYPES.boolean,
+    description='Also write incoming events to compressed, rotating archives '\
+                '(in `logs/archive`), with an index so we can pull out one '\
+                'student or session without decompressing everything.',
+    default=False
+)
+pmss.register_field(
+    name='event_archive_compression',
+    type=pmss.pmsstypes.TYPES.string,
+    description='Compression for event archives: `gzip`, or `zstd` (which '\
+                'needs the `zstandard` package).',
+    default='gzip'
+)
+pmss.register_field(
+    name='event_archive_block_bytes',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='Events are compressed in independent blocks of about this '\
+                'many (uncompressed) bytes. Smaller blocks make lookups '\
+                'faster, and compression worse.',
+    default=262144
+)
+pmss.register_field(
+    name='event_archive_rotate_bytes',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='Start a new event archive once the current one is this big.',
+    default=256 * 1024 * 1024
+)
+pmss.register_field(
+    name='event_archive_rotate_seconds',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='Start a new event archive once the current one is this old.',
+    default=24 * 60 * 60
+)
+pmss.register_field(
+    name='event_archive_flush_seconds',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='Write out a partly-full archive block once its oldest event '\
+                'is this old, so quiet periods don\'t leave events in memory.',
+    default=60
+)
+pmss.register_field(
+    name='async_event_log',
+    type=pmss.pmsstypes.TYPES.boolean,
+    description='Write event logs from a background thread, in batches, rather '\
+                'than synchronously on the event loop. Events are buffered in '\
+                'memory for up to `event_log_flush_seconds` before they hit disk.',
+    default=False
+)
+pmss.register_field(
+    name='event_log_flush_seconds',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='With `async_event_log`, the longest we buffer events in memory '\
+                'before writing them to disk.',
+    default=1
+)
+pmss.register_field(
+    name='event_log_flush_bytes',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='With `async_event_log`, write buffered events to disk once '\
+                'this many bytes are pending.',
+    default=65536
+)
+pmss.register_field(
+    name='event_log_queue_size',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='With `async_event_log`, the most log lines we queue for the '\
+                'writer thread. If the disk falls this far behind, we drop '\
+                'log lines (and log that we did) rather than stall the server.',
+    default=10000
+)
+
 
 # Do we make files for exceptions? Do we print extra stuff on the console?
 #
@@ -180,6 +298,21 @@ def initialize_logging_framework():
         # with larger files later. tar.gz should save a lot more
         sfp.write(startup_state_dump)
 
+    files.max_open = settings.pmss_settings.max_open_log_files(types=['logging'])
+    global ORJSON_ENCODING
+    ORJSON_ENCODING = settings.pmss_settings.orjson_event_encoding(types=['logging'])
+    if ORJSON_ENCODING and orjson is None:
+        raise learning_observer.prestartup.StartupCheck(
+            "`orjson_event_encoding` is enabled, but `orjson` is not installed.\n"
+            "Please `pip install orjson`, or disable `orjson_event_encoding`."
+        )
+    # The archive must be started first, so that on exit, the writer
+    # drains into it before it is closed.
+    if settings.pmss_settings.event_archive(types=['logging']):
+        start_event_archive()
+    if settings.pmss_settings.async_event_log(types=['logging']):
+        start_log_writer()
+
 
 def encode_json_line(line):
     '''
@@ -205,25 +338,591 @@ def encode_json_block(block):
     return json.dumps(block, sort_keys=True, indent=3)
 
 
+def encode_event(event):
+    '''
+    The canonical encoding of an event, as `bytes`.
+
+    We encode each event once, and reuse the bytes for every log (main
+    log, per-session log, archive) and for hashing. With
+    `orjson_event_encoding`, this uses `orjson`.
+
+    >>> encode_event({'b': 1, 'a': 2})
+    b'{"a": 2, "b": 1}'
+    '''
+    if ORJSON_ENCODING:
+        return orjson.dumps(event, option=orjson.OPT_SORT_KEYS)
+    return encode_json_line(event).encode('utf-8')
+
+
+def encode_log_line(event, preencoded=False, timestamp=False):
+    '''
+    Turn an event into the bytes of one line of a log file. If
+    `preencoded`, the event is already encoded (as `str` or `bytes`).
+
+    >>> encode_log_line({'b': 1, 'a': 2})
+    b'{"a": 2, "b": 1}\\n'
+    >>> encode_log_line(b'{"a": 2}', preencoded=True)
+    b'{"a": 2}\\n'
+    '''
+    if not preencoded:
+        event = encode_event(event)
+    elif isinstance(event, str):
+        event = event.encode('utf-8')
+    if timestamp:
+        event = event + b"\t" + datetime.datetime.utcnow().isoformat().encode('utf-8')
+    return event + b"\n"
+
+
+def open_logfile(filename):
+    '''
+    Open a per-session log file for appending
+    '''
+    return open(paths.logs("" + filename + ".log"), "ab", 0)
+
+
+class LogFilePool:
+    '''
+    Open file handles for per-session log files, with at most
+    `max_open` open at a time.
+
+    We have a log file per websocket session, and a school-wide
+    deploy might have thousands of sessions at once, which runs into
+    `ulimit -n`. Sockets which die uncleanly also leak handles. Here,
+    once we hit `max_open`, we close the least recently used file. If
+    more events come in for it, we reopen it in append mode.
+
+    We count open, evicted, and reopened handles, for monitoring.
+
+    This is not thread-safe. Each thread which writes logs should have
+    its own pool.
+    '''
+    def __init__(self, max_open=256):
+        self.max_open = max_open
+        # filename -> handle, least recently used first
+        self._handles = collections.OrderedDict()
+        # Files we've opened, and not yet closed (including evicted ones)
+        self._filenames = set()
+        self.evicted = 0
+        self.reopened = 0
+
+    def __contains__(self, filename):
+        return filename in self._filenames
+
+    def get(self, filename):
+        '''
+        Return an open handle for `filename`, (re)opening it if needed
+        '''
+        if filename in self._handles:
+            self._handles.move_to_end(filename)
+            return self._handles[filename]
+        if filename in self._filenames:
+            self.reopened += 1
+        while self._handles and len(self._handles) >= self.max_open:
+            _, handle = self._handles.popitem(last=False)
+            handle.close()
+            self.evicted += 1
+        handle = open_logfile(filename)
+        self._handles[filename] = handle
+        self._filenames.add(filename)
+        return handle
+
+    def close(self, filename):
+        '''
+        We're done with `filename`. Close it, if it's open.
+        '''
+        self._filenames.discard(filename)
+        handle = self._handles.pop(filename, None)
+        if handle is not None:
+            handle.close()
+
+    def close_all(self):
+        for filename in list(self._filenames):
+            self.close(filename)
+
+    def metrics(self):
+        '''
+        Handle counts, for monitoring
+
+        >>> LogFilePool().metrics()
+        {'open': 0, 'sessions': 0, 'evicted': 0, 'reopened': 0}
+        '''
+        return {
+            'open': len(self._handles),
+            'sessions': len(self._filenames),
+            'evicted': self.evicted,
+            'reopened': self.reopened
+        }
+
+
+# Per-session log files, when logging synchronously
+files = LogFilePool()
+
+
+class LogWriter:
+    '''
+    Writes event logs from a background thread.
+
+    Otherwise, we write (and flush) each event to disk synchronously,
+    twice per event (main log and per-session log), on the event
+    loop. A slow disk then stalls websocket ingestion.
+
+    Here, `log_event` just puts the encoded line in a bounded queue.
+    The writer thread batches lines per file, and writes them out once
+    `flush_bytes` are pending or `flush_seconds` have passed. On
+    shutdown, `stop` drains the queue, so we don't lose events.
+
+    We're called from the event loop, so we never wait on the queue.
+    If the disk falls so far behind that the queue fills up, we drop
+    what we can't queue, count it in `dropped`, and log it. Dropping
+    a close just leaves the file to the pool's LRU.
+    '''
+    _WRITE = 'write'
+    _CLOSE = 'close'
+    _ARCHIVE = 'archive'
+    _STOP = 'stop'
+
+    def __init__(self, flush_seconds=1, flush_bytes=65536, queue_size=10000, max_open=256):
+        self.flush_seconds = flush_seconds
+        self.flush_bytes = flush_bytes
+        self.queue = queue.Queue(maxsize=queue_size)
+        # Operation -> how many we dropped because the queue was full
+        self.dropped = collections.Counter()
+        # Per-session files we've been sent lines for, and not yet closed
+        self.filenames = set()
+        # Only touched from the writer thread
+        self.files = LogFilePool(max_open)
+        self._thread = threading.Thread(target=self._run, name="LogWriter", daemon=True)
+        self._thread.start()
+
+    def write(self, filename, line):
+        '''
+        Queue `line` (bytes) to be written to the log `filename` (or
+        the main log, if `None`).
+        '''
+        if filename is not None:
+            self.filenames.add(filename)
+        self._put(self._WRITE, filename, line)
+
+    def close(self, filename):
+        '''
+        Write out anything pending for `filename`, and close it.
+        '''
+        self.filenames.discard(filename)
+        self._put(self._CLOSE, filename, None)
+
+    def archive(self, archive, record):
+        '''
+        Queue an `EventArchive.append`, so compression happens on the
+        writer thread too.
+        '''
+        self._put(self._ARCHIVE, archive, record)
+
+    def _put(self, operation, filename, item):
+        try:
+            self.queue.put_nowait((operation, filename, item))
+        except queue.Full:
+            self.dropped[operation] += 1
+            total = sum(self.dropped.values())
+            # Log the first drop, and then every so often
+            if total == 1 or total % 1000 == 0:
+                debug_log("Event log queue full. Dropped so far:", dict(self.dropped))
+
+    def stop(self):
+        '''
+        Write out everything queued, close all files, and stop the
+        writer thread.
+        '''
+        if self._thread.is_alive():
+            self.queue.put((self._STOP, None, None))
+            self._thread.join()
+
+    def _handle(self, filename):
+        if filename is None:
+            return mainlog
+        return self.files.get(filename)
+
+    def _flush(self, pending, filename):
+        lines = pending.pop(filename, None)
+        if not lines:
+            return
+        try:
+            self._handle(filename).write(b"".join(lines))
+        except Exception:
+            # We can't raise anywhere useful from this thread, but we
+            # also don't want one bad file to stop all logging.
+            traceback.print_exc()
+
+    def _run(self):
+        pending = collections.defaultdict(list)
+        pending_bytes = 0
+        last_flush = time.monotonic()
+        running = True
+        while running:
+            timeout = max(0, self.flush_seconds - (time.monotonic() - last_flush))
+            try:
+                operation, filename, line = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                operation = None
+            if operation == self._WRITE:
+                pending[filename].append(line)
+                pending_bytes += len(line)
+            elif operation == self._CLOSE:
+                self._flush(pending, filename)
+                self.files.close(filename)
+            elif operation == self._ARCHIVE:
+                archive, record = filename, line
+                try:
+                    archive.append(*record)
+                except Exception:
+                    traceback.print_exc()
+            elif operation == self._STOP:
+                running = False
+
+            if not running or pending_bytes >= self.flush_bytes or \
+               time.monotonic() - last_flush >= self.flush_seconds:
+                for filename in list(pending):
+                    self._flush(pending, filename)
+                pending_bytes = 0
+                last_flush = time.monotonic()
+
+        self.files.close_all()
+
+
+def start_log_writer():
+    '''
+    Switch event logging over to a background `LogWriter`. The writer
+    is drained when the process exits.
+    '''
+    global LOG_WRITER
+    if LOG_WRITER is not None:
+        return LOG_WRITER
+    LOG_WRITER = LogWriter(
+        flush_seconds=settings.pmss_settings.event_log_flush_seconds(types=['logging']),
+        flush_bytes=settings.pmss_settings.event_log_flush_bytes(types=['logging']),
+        queue_size=settings.pmss_settings.event_log_queue_size(types=['logging']),
+        max_open=files.max_open
+    )
+    atexit.register(stop_log_writer)
+    return LOG_WRITER
+
+
+def stop_log_writer():
+    '''
+    Write out any buffered events, and go back to logging synchronously.
+    '''
+    global LOG_WRITER
+    if LOG_WRITER is not None:
+        LOG_WRITER.stop()
+        LOG_WRITER = None
+
+
+def _compress_block(data, compression):
+    if compression == 'gzip':
+        return gzip.compress(data)
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().compress(data)
+    raise ValueError("Unknown archive compression: {}".format(compression))
+
+
+def _decompress_block(data, compression):
+    if compression == 'gzip':
+        return gzip.decompress(data)
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError("Unknown archive compression: {}".format(compression))
+
+
+ARCHIVE_EXTENSIONS = {
+    'gzip': '.jsonl.gz',
+    'zstd': '.jsonl.zst'
+}
+
+
+class EventArchive:
+    '''
+    Compressed, rotating archives of incoming events.
+
+    Events are buffered into blocks of about `block_bytes`, and each
+    block is compressed as an independent gzip member (or zstd frame)
+    and appended to the archive. A gzip archive is therefore still a
+    normal `.gz` file. Each line is an event, a tab, and the session
+    (per-session log file name) it came from.
+
+    Next to each archive, we keep a sidecar index (`.index`), with one
+    JSON line per block: its offset and length, the students and
+    sessions in it, and its time range. `read_archive` uses this to
+    decompress only the blocks it needs.
+
+    We start a new archive once the current one reaches `rotate_bytes`,
+    or is `rotate_seconds` old. A block is written out early once its
+    first event is `flush_seconds` old.
+
+    Those checks happen as events come in, so on a quiet stream, they
+    also need `tick()` calling every so often (`start_event_archive`
+    does this from a timer thread). Methods take a lock, since `tick()`
+    runs on a different thread from `append()`.
+    '''
+    def __init__(
+            self,
+            directory,
+            compression='gzip',
+            block_bytes=262144,
+            rotate_bytes=256 * 1024 * 1024,
+            rotate_seconds=24 * 60 * 60,
+            flush_seconds=60
+    ):
+        if compression not in ARCHIVE_EXTENSIONS:
+            raise ValueError("Unknown archive compression: {}".format(compression))
+        self.directory = directory
+        self.compression = compression
+        self.block_bytes = block_bytes
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.flush_seconds = flush_seconds
+        self.filename = None
+        self._fp = None
+        self._opened = None
+        self._count = 0
+        self._lock = threading.RLock()
+        self._new_block()
+
+    def _new_block(self):
+        self._lines = []
+        self._block_started = None
+        self._bytes = 0
+        self._students = set()
+        self._sessions = set()
+        self._start = None
+        self._end = None
+
+    def _open(self):
+        self.filename = os.path.join(self.directory, "{time}-{pid}-{count:0>4}{extension}".format(
+            time=datetime.datetime.utcnow().isoformat(),
+            pid=os.getpid(),
+            count=self._count,
+            extension=ARCHIVE_EXTENSIONS[self.compression]
+        ))
+        self._count += 1
+        self._fp = open(self.filename, "ab")
+        self._opened = time.monotonic()
+
+    def append(self, line, student=None, session=None, timestamp=None):
+        '''
+        Add one encoded event (`bytes`, without a newline) to the archive.
+        '''
+        with self._lock:
+            self._append(line, student, session, timestamp)
+
+    def _append(self, line, student, session, timestamp):
+        if self._block_started is None:
+            self._block_started = time.monotonic()
+        session_text = session or ""
+        self._lines.append(line + b"\t" + session_text.encode('utf-8') + b"\n")
+        self._bytes += len(self._lines[-1])
+        if student is not None:
+            self._students.add(student)
+        if session is not None:
+            self._sessions.add(session)
+        if timestamp is not None:
+            self._start = timestamp if self._start is None else min(self._start, timestamp)
+            self._end = timestamp if self._end is None else max(self._end, timestamp)
+
+        if self._bytes >= self.block_bytes:
+            self.write_block()
+        else:
+            self.tick()
+
+    def tick(self):
+        '''
+        Write out the current block if it's been waiting too long, and
+        rotate if the archive is too old.
+        '''
+        with self._lock:
+            now = time.monotonic()
+            if self._lines and now - self._block_started >= self.flush_seconds:
+                self.write_block()
+            elif self._fp is not None and now - self._opened >= self.rotate_seconds:
+                if self._lines:
+                    self.write_block()
+                else:
+                    self._fp.close()
+                    self._fp = None
+
+    def write_block(self):
+        '''
+        Compress and write out the current block, and rotate if needed.
+        '''
+        with self._lock:
+            self._write_block()
+
+    def _write_block(self):
+        if not self._lines:
+            return
+        if self._fp is None:
+            self._open()
+        block = _compress_block(b"".join(self._lines), self.compression)
+        offset = self._fp.tell()
+        self._fp.write(block)
+        self._fp.flush()
+        with open(self.filename + ".index", "a") as index_fp:
+            index_fp.write(encode_json_line({
+                'offset': offset,
+                'length': len(block),
+                'events': len(self._lines),
+                'students': sorted(self._students),
+                'sessions': sorted(self._sessions),
+                'start': self._start,
+                'end': self._end
+            }) + "\n")
+        self._new_block()
+
+        if self._fp.tell() >= self.rotate_bytes or \
+           time.monotonic() - self._opened >= self.rotate_seconds:
+            self._fp.close()
+            self._fp = None
+
+    def close(self):
+        '''
+        Write out anything buffered, and close the archive.
+        '''
+        with self._lock:
+            self._write_block()
+            if self._fp is not None:
+                self._fp.close()
+                self._fp = None
+
+
+def read_archive(filename, student=None, session=None, start=None, end=None):
+    '''
+    Iterate over the events in an archive written by `EventArchive`,
+    optionally only for one student and/or session, and/or within a
+    time range. If there is an index, we seek straight to the blocks
+    we need.
+    '''
+    compression = 'zstd' if filename.endswith(ARCHIVE_EXTENSIONS['zstd']) else 'gzip'
+
+    def wanted(entry):
+        if student is not None and student not in entry['students']:
+            return False
+        if session is not None and session not in entry['sessions']:
+            return False
+        if start is not None and entry['end'] is not None and entry['end'] < start:
+            return False
+        if end is not None and entry['start'] is not None and entry['start'] > end:
+            return False
+        return True
+
+    def blocks(fp):
+        if os.path.exists(filename + ".index"):
+            with open(filename + ".index") as index_fp:
+                for line in index_fp:
+                    entry = json.loads(line)
+                    if wanted(entry):
+                        fp.seek(entry['offset'])
+                        yield _decompress_block(fp.read(entry['length']), compression)
+        else:
+            yield _decompress_block(fp.read(), compression)
+
+    with open(filename, "rb") as fp:
+        for block in blocks(fp):
+            for line in block.splitlines():
+                event_text, _, line_session = line.decode('utf-8').rpartition("\t")
+                if session is not None and line_session != session:
+                    continue
+                event = json.loads(event_text)
+                if student is not None and _event_student(event) != student:
+                    continue
+                timestamp = _event_timestamp(event)
+                if start is not None and timestamp is not None and timestamp < start:
+                    continue
+                if end is not None and timestamp is not None and timestamp > end:
+                    continue
+                yield event
+
+
+def _event_student(event):
+    return event.get('metadata', {}).get('auth', {}).get('safe_user_id')
+
+
+def _event_timestamp(event):
+    return event.get('server', {}).get('time')
+
+
+def start_event_archive():
+    '''
+    Start archiving events, as per the settings. The archive is closed
+    when the process exits.
+    '''
+    global ARCHIVE
+    if ARCHIVE is not None:
+        return ARCHIVE
+    if not os.path.exists(paths.logs("archive")):
+        os.mkdir(paths.logs("archive"))
+    ARCHIVE = EventArchive(
+        paths.logs("archive"),
+        compression=settings.pmss_settings.event_archive_compression(types=['logging']),
+        block_bytes=settings.pmss_settings.event_archive_block_bytes(types=['logging']),
+        rotate_bytes=settings.pmss_settings.event_archive_rotate_bytes(types=['logging']),
+        rotate_seconds=settings.pmss_settings.event_archive_rotate_seconds(types=['logging']),
+        flush_seconds=settings.pmss_settings.event_archive_flush_seconds(types=['logging'])
+    )
+    atexit.register(ARCHIVE.close)
+
+    def tick(archive):
+        # Daemon thread, so this just stops when the process exits
+        while True:
+            time.sleep(max(1, min(archive.flush_seconds, archive.rotate_seconds) / 4))
+            try:
+                archive.tick()
+            except Exception:
+                traceback.print_exc()
+
+    threading.Thread(target=tick, args=(ARCHIVE,), name="EventArchiveTick", daemon=True).start()
+    return ARCHIVE
+
+
+def archive_event(event, session=None, encoded=None):
+    '''
+    Add an incoming event to the compressed archive, if archiving is
+    enabled. `session` is the name of the per-session log file.
+    `encoded` is the event as encoded by `encode_event`, if we have it.
+    '''
+    if ARCHIVE is None:
+        return
+    if encoded is None:
+        encoded = encode_event(event)
+    record = (
+        encoded,
+        _event_student(event),
+        session,
+        _event_timestamp(event)
+    )
+    if LOG_WRITER is not None:
+        LOG_WRITER.archive(ARCHIVE, record)
+    else:
+        ARCHIVE.append(*record)
+
+
 def log_event(event, filename=None, preencoded=False, timestamp=False):
     '''
     This isn't done, but it's how we log events for now.
+
+    If we're logging the same event to several places, encode it once
+    with `encode_event`, and pass the bytes with `preencoded=True`.
     '''
+    line = encode_log_line(event, preencoded, timestamp)
+    if LOG_WRITER is not None:
+        LOG_WRITER.write(filename, line)
+        return
+
     if filename is None:
         log_file_fp = mainlog
-    elif filename in files:
-        log_file_fp = files[filename]
     else:
-        log_file_fp = open(paths.logs("" + filename + ".log"), "ab", 0)
-        files[filename] = log_file_fp
+        log_file_fp = files.get(filename)
 
-    if not preencoded:
-        event = encode_json_line(event)
-    log_file_fp.write(event.encode('utf-8'))
-    if timestamp:
-        log_file_fp.write("\t".encode('utf-8'))
-        log_file_fp.write(datetime.datetime.utcnow().isoformat().encode('utf-8'))
-    log_file_fp.write("\n".encode('utf-8'))
+    log_file_fp.write(line)
     log_file_fp.flush()
 
 
@@ -243,6 +942,20 @@ def print_to_string(*args, **kwargs):
     return contents
 
 
+def debug_log_enabled():
+    '''
+    Are we printing debug messages? On hot paths (per event, per
+    message), guard `debug_log` calls with this:
+
+        if debug_log_enabled():
+            debug_log("Processing", event)
+
+    Otherwise, we pay for building the arguments (string formatting,
+    etc.) even when debug logging is off, as it is in deployment.
+    '''
+    return DEBUG_LOG_LEVEL is not LogLevel.NONE
+
+
 def debug_log(*args):
     '''
     Helper function to help us trace our code.
@@ -253,11 +966,13 @@ def debug_log(*args):
     This is not intended for programmatic debugging. We do change
     format regularly (and you should feel free to do so too -- for
     example, on narrower terminals, a `\n\t` can help)
+
+    On hot paths, see `debug_log_enabled`.
     '''
-    if DEBUG_LOG_LEVEL not in (LogLevel.NONE, LogLevel.SIMPLE, LogLevel.EXTENDED):
-        raise ValueError("Invalid debug log type: {}".format(DEBUG_LOG_LEVEL))
-    if DEBUG_LOG_LEVEL == LogLevel.NONE:
+    if DEBUG_LOG_LEVEL is LogLevel.NONE:
         return
+    if DEBUG_LOG_LEVEL not in (LogLevel.SIMPLE, LogLevel.EXTENDED):
+        raise ValueError("Invalid debug log type: {}".format(DEBUG_LOG_LEVEL))
     text = print_to_string(*args)
     if DEBUG_LOG_LEVEL == LogLevel.SIMPLE:
         message = text
@@ -315,14 +1030,28 @@ def log_ajax(url, resp_json, request):
 
 def close_logfile(filename):
     # remove the file from the dict storing open log files and close it
+    if LOG_WRITER is not None:
+        if filename not in LOG_WRITER.filenames:
+            log_event("[Empty log file -- no events captured]", preencoded=True, filename=filename)
+        LOG_WRITER.close(filename)
+        return
     if filename not in files:
-        # If we logged no events, the file was never created, so the code
-        # below fails. This forces the file to be created, and marked
+        # If we logged no events, the file was never created. This
+        # forces the file to be created, and marked
         # as empty, which also gives some logging of something having
         # happened.
         #
         # I don't know if this is the right sentinel to use. Empty file? A
         # single event of some kind?
         log_event("[Empty log file -- no events captured]", preencoded=True, filename=filename)
-    old_file = files.pop(filename)
-    old_file.close()
+    files.close(filename)
+
+
+def log_file_metrics():
+    '''
+    How many per-session log files are open, how many sessions we
+    have, and how often we've had to close and reopen files.
+    '''
+    if LOG_WRITER is not None:
+        return LOG_WRITER.files.metrics()
+    return files.metrics()
@@ -68,14 +68,13 @@ It is very much a prototype. To make this not a prototype, we would need to:
 import hashlib
 import json
 import datetime
-from modulefinder import STORE_GLOBAL
 import os
-from pickle import STOP
+import sqlite3
+import time
 
 # These should be abstracted out into a visualization library.
 import matplotlib
 import networkx
-from learning_observer.incoming_student_event import COUNT
 import pydot
 
 from confluent_kafka import Producer, Consumer
@@ -186,7 +185,7 @@ class Merkle:
         self.categories = categories
 
     # These are generic to interact with the Merkle DAG
-    def event_to_session(self, event, session, children=None, label=None):
+    def event_to_session(self, event, session, children=None, label=None, encoded=None):
         '''
         Append an event to the merkle tree.
 
@@ -218,48 +217,73 @@ class Merkle:
             label (str): An optional human-friendly label for this event. This
                 should NOT be relied on programmatically, or to be unique. It's
                 just for human consumption, e.g. when making visualizations.
+            encoded (bytes): The event, as already encoded for the logs (see
+                `log_event.encode_event`). If given, we hash this, rather than
+                encoding the event again.
 
         Returns:
             dict: The event envelope, with the session updated, and the
                 hash computed.
         '''
-        # reverse() so we add children from the parameters to the end of the list
-        # of children. This isn't strictly necessary, but it is a little bit
-        # nicer to look at manually. We could remove the pair of reverse() calls,
-        # since this is an unordered list, if this ever becomes a problem.
-        if children is None:
-            children = list()
-        children.reverse()
+        return self.events_to_session(
+            [event],
+            session,
+            children=[children],
+            labels=[label],
+            encoded=[encoded]
+        )[0]
+
+    def events_to_session(self, events, session, children=None, labels=None, encoded=None):
+        '''
+        Append a batch of events to the merkle tree. This is the same as
+        calling `event_to_session` on each event, but we look up the end
+        of the chain once, hash the whole batch in one pass, and commit it
+        to storage in one write.
+
+        `children`, `labels`, and `encoded` are optional lists, with one
+        entry (which may be `None`) per event, as in `event_to_session`.
+
+        Returns the list of event envelopes.
+        '''
         storage = self.storage
         session_id = session_key(session)
-        ts = timestamp()
-
-        event_hash = hash(json_dump(event))
-        node_hash = hash(*children, ts)
 
         last_hash = None
         last_item = storage._most_recent_item(session_id)
-
         if last_item is not None:
             last_hash = last_item['hash']
-            children.append(last_hash)
-
-        children.append(event_hash)
-
-        children.reverse()
-        print(children)
-
-        item = {
-            'children': children,                 # Points to the full chain / children
-            'hash': node_hash,                    # Current node
-            'timestamp': ts,                      # Timestamp
-            'event': event
-        }
-        if label is not None:
-            item['label'] = label
-        storage._append_to_stream(session_id, item)
-        print(item['hash'])
-        return item
+
+        items = []
+        for i, event in enumerate(events):
+            if encoded is not None and encoded[i] is not None:
+                event_hash = hash(encoded[i].decode('utf-8'))
+            else:
+                event_hash = hash(json_dump(event))
+
+            # The event and the previous item come first, followed by
+            # children from the parameters. This isn't strictly necessary,
+            # since this is an unordered list, but it is a little bit
+            # nicer to look at manually.
+            item_children = [event_hash]
+            if last_hash is not None:
+                item_children.append(last_hash)
+            if children is not None and children[i] is not None:
+                item_children.extend(children[i])
+
+            ts = timestamp()
+            item = {
+                'children': item_children,            # Points to the full chain / children
+                'hash': hash(*item_children, ts),     # Current node
+                'timestamp': ts,                      # Timestamp
+                'event': event
+            }
+            if labels is not None and labels[i] is not None:
+                item['label'] = labels[i]
+            items.append(item)
+            last_hash = item['hash']
+
+        storage._append_items(session_id, items)
+        return items
 
     def start(self, session, metadata=None, continue_session=False):
         '''
@@ -384,6 +408,22 @@ class StreamStorage:
         '''
         raise NotImplementedError
 
+    def _append_items(self, stream, items):
+        '''
+        Append several items to a stream, in order. Back-ends which can
+        write these in one go (e.g. in one transaction) should override
+        this.
+        '''
+        for item in items:
+            self._append_to_stream(stream, item)
+
+    def close(self):
+        '''
+        Release anything we're holding open (connections, etc.). Back-ends
+        which hold nothing don't need to override this.
+        '''
+        pass
+
     def _walk(self):
         '''
         Walk the DAG. This is used for debugging.
@@ -480,13 +520,50 @@ class KafkaStorage(StreamStorage):
         raise NotImplementedError
 
 
+def last_line(filename, chunk_size=4096):
+    '''
+    Return the last line of a file (without the newline), or `None`
+    if the file doesn't exist or is empty. We read backwards from the
+    end of the file, so this doesn't depend on the length of the file.
+    '''
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        data = b''
+        position = end
+        while position > 0:
+            step = min(chunk_size, position)
+            position -= step
+            f.seek(position)
+            data = f.read(step) + data
+            # Ignore the trailing newline when looking for the line start
+            if data.rstrip(b'\n').count(b'\n') > 0:
+                break
+        lines = data.rstrip(b'\n').split(b'\n')
+        if not lines[-1]:
+            return None
+        return lines[-1].decode('utf-8')
+
+
 class FSStorage(StreamStorage):
     """
     A Merkle DAG implementation that uses a file system as a backing store.
     """
+    MAX_CACHED_TAILS = 10000
+
     def __init__(self, path):
         super().__init__()
         self.path = path
+        # stream -> (file size and mtime, most recent item). We append
+        # to streams on every event, and need the previous item to chain
+        # hashes, so we don't want to read the stream back each time.
+        #
+        # Other `FSStorage` objects (e.g. other connections, or other
+        # processes) may append to the same stream, so we only trust a
+        # cached item while the file is unchanged since we saw it.
+        self._tails = {}
 
     def _fn(self, stream):
         '''
@@ -502,15 +579,38 @@ class FSStorage(StreamStorage):
         '''
         Append an item to a stream.
         '''
+        self._append_items(stream, [item])
+
+    def _append_items(self, stream, items):
+        '''
+        Append several items to a stream, with one write.
+        '''
+        if not items:
+            return
         with open(self._fn(stream), 'a') as f:
-            f.write(json_dump(item))
-            f.write('\n')
+            f.write("".join(json_dump(item) + '\n' for item in items))
+            f.flush()
+            self._cache_tail(stream, os.fstat(f.fileno()), items[-1])
+
+    def _cache_tail(self, stream, stat, item):
+        '''
+        Remember the most recent item in a stream, as of when the file
+        had `stat`. We keep the most recently used `MAX_CACHED_TAILS`.
+        '''
+        self._tails.pop(stream, None)
+        self._tails[stream] = ((stat.st_size, stat.st_mtime_ns), item)
+        while len(self._tails) > self.MAX_CACHED_TAILS:
+            del self._tails[next(iter(self._tails))]
 
     def _rename_or_alias_stream(self, stream, alias):
         '''
         Rename a stream.
         '''
         os.rename(self._fn(stream), self._fn(alias))
+        self._tails.pop(alias, None)
+        # A rename keeps the size and mtime, so the cached item is still good
+        if stream in self._tails:
+            self._tails[alias] = self._tails.pop(stream)
 
     def _get_stream_data(self, stream):
         '''
@@ -526,17 +626,30 @@ class FSStorage(StreamStorage):
         Delete a stream.
         '''
         os.remove(self._fn(sha_key))
+        self._tails.pop(sha_key, None)
 
     def _most_recent_item(self, stream):
         '''
         Get the most recent item in a stream.
+
+        This comes from the cache if we've written to or read from the
+        stream before, and the file hasn't changed since. Otherwise, we
+        read just the last line of the file.
         '''
-        data = self._get_stream_data(stream)
-        if data is None:
+        try:
+            stat = os.stat(self._fn(stream))
+        except FileNotFoundError:
+            self._tails.pop(stream, None)
             return None
-        if len(data) == 0:
+        cached = self._tails.get(stream)
+        if cached is not None and cached[0] == (stat.st_size, stat.st_mtime_ns):
+            return cached[1]
+        line = last_line(self._fn(stream))
+        if line is None:
             return None
-        return data[-1]
+        item = json_load(line)
+        self._cache_tail(stream, stat, item)
+        return item
 
     def _walk(self):
         '''
@@ -548,6 +661,125 @@ class FSStorage(StreamStorage):
                     yield json_load(line)
 
 
+class SQLiteStorage(StreamStorage):
+    """
+    A Merkle DAG implementation that uses SQLite as a backing store.
+
+    Nodes are stored once, by hash, in `items`. Streams are ordered
+    rows in `streams`, pointing to nodes by hash. Everything we need
+    on the hot path (most recent item, renames) is an index lookup,
+    and appends of several items are one transaction. We run SQLite
+    in WAL mode, so readers don't block the writer.
+    """
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # With WAL, this is still safe against corruption, but a power
+        # failure can lose the last few transactions.
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS items (hash TEXT PRIMARY KEY, item TEXT NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS streams ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, stream TEXT NOT NULL, hash TEXT NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS streams_by_stream ON streams (stream, id)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS streams_by_hash ON streams (hash)"
+            )
+
+    def _append_to_stream(self, stream, item):
+        '''
+        Append an item to a stream.
+        '''
+        self._append_items(stream, [item])
+
+    def _append_items(self, stream, items):
+        '''
+        Append several items to a stream, in one transaction.
+        '''
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO items (hash, item) VALUES (?, ?)",
+                [(item['hash'], json_dump(item)) for item in items]
+            )
+            self.connection.executemany(
+                "INSERT INTO streams (stream, hash) VALUES (?, ?)",
+                [(stream, item['hash']) for item in items]
+            )
+
+    def _rename_or_alias_stream(self, stream, alias):
+        '''
+        Rename a stream. As with `FSStorage`, this replaces any
+        existing stream called `alias`.
+        '''
+        if alias == stream:
+            return
+        with self.connection:
+            self.connection.execute("DELETE FROM streams WHERE stream = ?", (alias,))
+            self.connection.execute("UPDATE streams SET stream = ? WHERE stream = ?", (alias, stream))
+
+    def _get_stream_data(self, stream):
+        '''
+        Get the stream.
+        '''
+        rows = self.connection.execute(
+            "SELECT items.item FROM streams JOIN items ON streams.hash = items.hash "
+            "WHERE streams.stream = ? ORDER BY streams.id",
+            (stream,)
+        ).fetchall()
+        if not rows:
+            return None
+        return [json_load(row[0]) for row in rows]
+
+    def _delete_stream(self, sha_key):
+        '''
+        Delete a stream, and any nodes which aren't also in other
+        streams.
+        '''
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM items WHERE hash IN (SELECT hash FROM streams WHERE stream = ?) "
+                "AND hash NOT IN (SELECT hash FROM streams WHERE stream != ?)",
+                (sha_key, sha_key)
+            )
+            self.connection.execute("DELETE FROM streams WHERE stream = ?", (sha_key,))
+
+    def _most_recent_item(self, stream):
+        '''
+        Get the most recent item in a stream.
+        '''
+        row = self.connection.execute(
+            "SELECT items.item FROM streams JOIN items ON streams.hash = items.hash "
+            "WHERE streams.stream = ? ORDER BY streams.id DESC LIMIT 1",
+            (stream,)
+        ).fetchone()
+        if row is None:
+            return None
+        return json_load(row[0])
+
+    def close(self):
+        '''
+        Close the database connection. We make one storage object per
+        websocket, so without this, we'd leak a connection (and a file
+        handle or two) per connection.
+        '''
+        self.connection.close()
+
+    def _walk(self):
+        '''
+        Walk the DAG. This is used for debugging.
+        '''
+        for row in self.connection.execute("SELECT item FROM items"):
+            yield json_load(row[0])
+
+
 class InMemoryStorage(StreamStorage):
     """
     A Merkle DAG implementation that uses in-memory storage.
@@ -601,6 +833,7 @@ CATEGORIES = set(
 STORES = {
     "kafka": KafkaStorage,
     "fs": FSStorage,
+    "sqlite": SQLiteStorage,
     "inmemory": InMemoryStorage
 }
 
@@ -646,5 +879,37 @@ def test_case():
     Image.open(io.BytesIO(G.create_png())).show()
 
 
+def benchmark_append(storage, events=100000, report_every=10000):
+    """
+    Time appending `events` items to one stream, the way
+    `Merkle.event_to_session` does (look up the most recent item, then
+    append). Per-event cost should stay flat as the stream grows.
+    """
+    stream = "benchmark-{ts}".format(ts=timestamp())
+    start = time.perf_counter()
+    for i in range(1, events + 1):
+        last_item = storage._most_recent_item(stream)
+        storage._append_to_stream(stream, {
+            'children': [] if last_item is None else [last_item['hash']],
+            'hash': hash(str(i)),
+            'timestamp': timestamp(),
+            'event': {'count': i}
+        })
+        if i % report_every == 0:
+            elapsed = time.perf_counter() - start
+            print("{i} events: {per:.1f}us per event".format(i=i, per=elapsed / report_every * 1e6))
+            start = time.perf_counter()
+    storage._delete_stream(stream)
+
+
 if __name__ == "__main__":
-    test_case()
+    import sys
+    if sys.argv[1:] == ['benchmark']:
+        if not os.path.exists('/tmp/merkle_dag'):
+            os.mkdir('/tmp/merkle_dag')
+        print("File system storage")
+        benchmark_append(FSStorage('/tmp/merkle_dag'))
+        print("SQLite storage")
+        benchmark_append(SQLiteStorage('/tmp/merkle_dag.sqlite'))
+    else:
+        test_case()
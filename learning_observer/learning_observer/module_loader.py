@@ -278,6 +278,10 @@ def load_reducers(component_name, module):
                 "function": reducer['function'],  # Primary ID
                 "scope": reducer.get('scope', DEFAULT_STUDENT_SCOPE),
                 "default": reducer.get('default', {}),
+                # Event types the reducer consumes / ignores. These may
+                # be declared here, or on the `kvs_pipeline` decorator.
+                "events": reducer.get('events', getattr(reducer['function'], 'events', None)),
+                "exclude_events": reducer.get('exclude_events', getattr(reducer['function'], 'exclude_events', None)),
                 "module": module,
                 "id": f"{module.__name__.replace('.module', '')}.{reducer['function'].__name__}"
             }
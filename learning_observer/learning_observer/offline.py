@@ -6,10 +6,14 @@ other applications, and in Jupyter notebooks.
 '''
 import argparse
 import asyncio
+import collections
+import concurrent.futures
 from cgi import print_arguments
+import gzip
 import json
 import sys
 import os
+import time
 
 import names
 
@@ -72,7 +76,9 @@ async def process_file(
     events_list=None,
     source=None,
     userid=None,
-    pipeline=None
+    pipeline=None,
+    student=None,
+    session=None
 ):
     '''
     Process a single log file.
@@ -84,6 +90,9 @@ async def process_file(
                       events.
         userid (str): The userid of the user that generated the events. If not
                         specified, the userid will be generated with `names`.
+        student (str): For event archives (`.jsonl.gz` / `.jsonl.zst`), only
+                       process events from this (safe) user ID.
+        session (str): For event archives, only process events from this session.
 
     Returns:
         Number of events processed, source, and userid
@@ -106,21 +115,20 @@ async def process_file(
     def opener():
         return events_list
 
-    if file_path is not None:
-        if file_path.endswith('.log'):
-            def file_opener():
-                return open(file_path)
-        elif file_path.endswith('.log.gz'):
-            def file_opener():
-                return gzip.open(file_path)
-        else:
+    if file_path is not None and file_path.endswith(tuple(learning_observer.log_event.ARCHIVE_EXTENSIONS.values())):
+        # Event archives have an index, so we can skip straight to the
+        # blocks with this student / session
+        def opener():
+            return learning_observer.log_event.read_archive(file_path, student=student, session=session)
+    elif file_path is not None:
+        if not file_path.endswith(('.log', '.log.gz')):
             raise ValueError("Unknown file type: " + file_path)
 
         def opener():
-            return (json.loads(line) for line in file_opener().readlines())
+            return stream_events(file_path)
 
     if source is None:
-        for event in opener:
+        for event in opener():
             source = event['client']['source']
             break
 
@@ -149,6 +157,9 @@ async def process_file(
         except Exception:
             print(event)
             raise
+    flush = getattr(pipeline, 'flush', None)
+    if flush is not None:
+        await flush()
 
     return n, source, userid
 
@@ -188,11 +199,181 @@ async def process_dir(path=os.getcwd()):
     This function will process all log files in the directory, and
     print the results.
     '''
-    files = [os.path.join(path, f) for f in os.listdir(path) if f.endswith('.log')]
+    files = log_files(path)
     events_processed = await process_files(files)
     return len(files), events_processed
 
 
+def log_files(path):
+    '''
+    All of the `.log` and `.log.gz` files in a directory, in a stable
+    order.
+    '''
+    return sorted(
+        os.path.join(path, f) for f in os.listdir(path)
+        if f.endswith(('.log', '.log.gz'))
+    )
+
+
+def stream_events(file_path):
+    '''
+    Iterate over the events in a `.log` or `.log.gz` file, one line at
+    a time, so we never hold a whole log in memory.
+
+    Study logs have a tab and a timestamp after the JSON. JSON escapes
+    tabs inside strings, so we can split on the first one.
+    '''
+    if file_path.endswith('.gz'):
+        fp = gzip.open(file_path, 'rt')
+    else:
+        fp = open(file_path)
+    with fp:
+        for line in fp:
+            line = line.split('\t', 1)[0].strip()
+            if line:
+                yield json.loads(line)
+
+
+def file_student(file_path, max_events=None):
+    '''
+    Guess which student a log file belongs to, from the (safe) user ID
+    in the first event which has one. We usually find it in the first
+    few events, but the auth event can come late, so by default, we'll
+    read the whole file looking (set `max_events` to stop sooner).
+    Returns `None` if we can't tell.
+    '''
+    for i, event in enumerate(stream_events(file_path)):
+        if max_events is not None and i >= max_events:
+            break
+        student = learning_observer.log_event._event_student(event)
+        if student is not None:
+            return student
+    return None
+
+
+def shard_by_student(files):
+    '''
+    Group log files by student, keeping each student's files in order.
+    Reducers keep per-student state, so one student's events must be
+    replayed in order, by one worker.
+
+    Files we can't attribute to a student all go into one shard, under
+    `None`. `replay` skips these: we don't know whose events they are,
+    and `process_file` would make up a (different) student for each.
+
+    Returns a dictionary of student to a shard (`{"student": ..., "files": [...]}`).
+    '''
+    shards = collections.OrderedDict()
+    for file_path in files:
+        student = file_student(file_path)
+        shards.setdefault(student, {"student": student, "files": []})
+        shards[student]["files"].append(file_path)
+    return shards
+
+
+def _replay_shard(files, source, student):
+    '''
+    Runs in a worker process. Replay one student's files into the
+    worker's in-memory KVS, and send back what got written.
+    '''
+    async def replay_files():
+        kvs = learning_observer.kvs.KVS()
+        if not isinstance(kvs, learning_observer.kvs.InMemoryKVS):
+            raise TypeError(
+                "Replay workers need the `stub` (in-memory) KVS, since they send "
+                f"back what they wrote, but have {type(kvs).__name__}"
+            )
+        await kvs.clear()  # Workers are reused across shards
+        n = 0
+        for file_path in files:
+            count, _, _ = await process_file(file_path, source=source, userid=student)
+            n += count
+        return n, await kvs.dump()
+    return asyncio.run(replay_files())
+
+
+async def merge_into_kvs(data, kvs=None):
+    '''
+    Write a KVS dump (as from `kvs.dump()`) into `kvs`, batching the
+    writes. Secondary indexes are unioned, rather than overwritten.
+    '''
+    if kvs is None:
+        kvs = learning_observer.kvs.KVS()
+    items = []
+    for key, value in data.items():
+        if key.startswith(learning_observer.kvs.INDEX_KEY_PREFIX):
+            index = key[len(learning_observer.kvs.INDEX_KEY_PREFIX):]
+            for member in value:
+                await kvs.index_add([index], member)
+        else:
+            items.append((key, value))
+    if items:
+        await kvs.multiset(items)
+
+
+async def replay(files, processes=None, source=None, settings=INTERACTIVE_SETTINGS):
+    '''
+    Replay many log files in parallel, e.g. to re-reduce a semester of
+    logs after a reducer change.
+
+    Files are sharded by student, and shards are spread over a pool of
+    `processes` worker processes (by default, one per CPU). Each worker
+    reduces into its own in-memory KVS, and we merge the results into
+    this process's KVS as each shard finishes. Since shards don't share
+    students, per-student keys never collide. Keys which aren't scoped
+    by student (if any) are last-writer-wins. Files where we can't find
+    a student are skipped (and counted), rather than being merged in
+    under made-up students.
+
+    Args:
+        files (list): `.log` / `.log.gz` files to replay
+        processes (int): Number of worker processes
+        source (str): Event source, if not inferred from the events
+        settings (dict): Settings for the workers. These must use the
+            `stub` KVS, since workers send their results back to us.
+
+    Returns:
+        Number of events processed, and events per second
+    '''
+    if isinstance(settings, dict):
+        kvs_type = settings.get('kvs', {}).get('default', {}).get('type')
+        if kvs_type != 'stub':
+            raise ValueError(f"Replay workers need the `stub` KVS, not `{kvs_type}`")
+    start = time.perf_counter()
+    shards = shard_by_student(files)
+    unattributed = shards.pop(None, {"files": []})["files"]
+    loop = asyncio.get_running_loop()
+    total = 0
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=processes,
+            initializer=init,
+            initargs=(settings,)
+    ) as executor:
+        futures = [
+            loop.run_in_executor(executor, _replay_shard, shard["files"], source, shard["student"])
+            for shard in shards.values()
+        ]
+        for future in asyncio.as_completed(futures):
+            n, data = await future
+            await merge_into_kvs(data)
+            total += n
+    elapsed = time.perf_counter() - start
+    rate = total / elapsed if elapsed > 0 else 0
+    print("{total} events from {files} files ({shards} students) in {elapsed:.1f}s: {rate:.0f} events/second".format(
+        total=total,
+        files=len(files) - len(unattributed),
+        shards=len(shards),
+        elapsed=elapsed,
+        rate=rate
+    ))
+    if unattributed:
+        print("Skipped {count} files with no student: {files}".format(
+            count=len(unattributed),
+            files=", ".join(unattributed)
+        ))
+    return total, rate
+
+
 async def reset():
     '''
     Reset the Learning Observer library, clearing all processed events
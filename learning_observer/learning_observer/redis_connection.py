@@ -71,20 +71,114 @@ async def keys():
     return [key.decode('utf-8') for key in await (await connection()).keys()]
 
 
+async def scan_keys(match=None, count=None):
+    '''
+    Iterate over keys with `SCAN`, optionally filtered by a `MATCH`
+    glob. In contrast to `keys()`, this does not block redis while it
+    walks the keyspace, and does not build one big list.
+
+    `count` is a hint to redis about how many keys to examine per
+    round trip.
+    '''
+    async for key in (await connection()).scan_iter(match=match, count=count):
+        yield key.decode('utf-8')
+
+
 async def get(key):
     '''
-    Get a key. We should eventually do multi-gets. Returns a future.
+    Get a key. Returns a future.
     '''
     return await (await connection()).get(key)
 
 
+async def mget(keys):
+    '''
+    Get a list of keys in a single round trip, with `MGET`. Returns a
+    list of values in the same order as `keys`, with `None` for
+    missing keys.
+    '''
+    keys = list(keys)
+    if len(keys) == 0:
+        return []
+    return await (await connection()).mget(keys)
+
+
 async def set(key, value, expiry=None):
     '''
-    Set a key. We should eventually do multi-sets. Returns a future.
+    Set a key. Returns a future.
     '''
     return await (await connection()).set(key, value, expiry)
 
 
+async def mset(items, expiry=None):
+    '''
+    Set a list of `(key, value)` pairs in a single round trip.
+
+    `MSET` does not support expiration, so we pipeline `SET` (or
+    `SETEX`, when `expiry` is given) commands instead. The pipeline is
+    not transactional; we only care about batching the round trips.
+    '''
+    items = list(items)
+    if len(items) == 0:
+        return []
+    pipeline = (await connection()).pipeline(transaction=False)
+    for key, value in items:
+        if expiry is None:
+            pipeline.set(key, value)
+        else:
+            pipeline.setex(key, expiry, value)
+    return await pipeline.execute()
+
+
+async def sadd_many(keys, member):
+    '''
+    Add `member` to each of the sets in `keys`, pipelined into a
+    single round trip.
+    '''
+    keys = list(keys)
+    if len(keys) == 0:
+        return []
+    pipeline = (await connection()).pipeline(transaction=False)
+    for key in keys:
+        pipeline.sadd(key, member)
+    return await pipeline.execute()
+
+
+async def srem_many(keys, member):
+    '''
+    Remove `member` from each of the sets in `keys`, pipelined into a
+    single round trip.
+    '''
+    keys = list(keys)
+    if len(keys) == 0:
+        return []
+    pipeline = (await connection()).pipeline(transaction=False)
+    for key in keys:
+        pipeline.srem(key, member)
+    return await pipeline.execute()
+
+
+async def exists_many(keys):
+    '''
+    Which of `keys` exist? Returns a list of booleans, from pipelined
+    `EXISTS` commands (so we don't fetch the values).
+    '''
+    keys = list(keys)
+    if len(keys) == 0:
+        return []
+    pipeline = (await connection()).pipeline(transaction=False)
+    for key in keys:
+        pipeline.exists(key)
+    return [bool(result) for result in await pipeline.execute()]
+
+
+async def smembers(key):
+    '''
+    Return the members of the set at `key`, as a set of strings.
+    '''
+    return {member.decode('utf-8') for member in await (await connection()).smembers(key)}
+
+
 async def delete(key):
     '''
     Delete a key. Returns a future.
@@ -186,21 +186,19 @@ async def all_students():
     student IDs in redis. This should not be used in any form of
     large-scale production.
     '''
-    keys = await learning_observer.kvs.KVS().keys()
-    # Reduce list length by 2
-    internal_keys = [k for k in keys if k.startswith("Internal")]
-
-    # Pick out the STUDENT field, and place those in a list. This list should
-    # have length 1 (if the field is there) or 0 (if it is not).
-    student_field_lists = [[f for f in k.split(",") if f.startswith("STUDENT:")] for k in internal_keys]
-
-    # Drop invalid keys, as well as ones which don't have a student field.
-    #
-    # For the remaining ones -- ones with a student ID -- just pick out the student ID.
-    user_ids = [k[0].split(":")[1] for k in student_field_lists if len(k) == 1]
-
-    # Drop duplicates
-    return sorted(set(user_ids))
+    user_ids = set()
+    # Only internal keys with a student field; the KVS filters these for us.
+    async for key in learning_observer.kvs.KVS().iter_keys(prefix="Internal,", pattern="*STUDENT:*"):
+        # Pick out the STUDENT field. This list should have length 1 (if
+        # the field is there) or 0 (if it is not).
+        student_fields = [f for f in key.split(",") if f.startswith("STUDENT:")]
+
+        # Drop invalid keys. For the remaining ones -- ones with a student
+        # ID -- just pick out the student ID. The set drops duplicates.
+        if len(student_fields) == 1:
+            user_ids.add(student_fields[0].split(":")[1])
+
+    return sorted(user_ids)
 
 
 async def all_ajax(
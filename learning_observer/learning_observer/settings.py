@@ -225,7 +225,7 @@ def initialized():
 # Not all of these are guaranteed to work on every branch of the codebase.
 AVAILABLE_FEATURE_FLAGS = [
     'uvloop', 'watchdog', 'auth_headers_page', 'merkle', 'save_google_ajax', 'use_google_ajax',
-    'google_routes', 'save_clean_ajax', 'use_clean_ajax'
+    'google_routes', 'save_clean_ajax', 'use_clean_ajax', 'event_acks'
 ]
 
 
@@ -12,8 +12,8 @@ This should move into a config file.
 '''
 
 import collections
-import copy
 import functools
+import inspect
 import learning_observer.exceptions
 import learning_observer.module_loader
 import learning_observer.util
@@ -21,17 +21,36 @@ import learning_observer.util
 from learning_observer.log_event import debug_log
 
 REDUCER_MODULES = None
+EVENT_DISPATCH = None
+
+# An immutable, precompiled description of a reducer, shared by all
+# connections from a given source:
+#
+# * `reducer`: called with connection metadata to make the per-connection
+#   event processor
+# * `scope`: the fields we reduce over
+# * `event_fields`: names of the event fields in the scope, so we don't
+#   walk the scope on every event
+# * `events` / `exclude_events`: the event types the reducer consumes /
+#   ignores (`None` if unspecified)
+ReducerSpec = collections.namedtuple(
+    'ReducerSpec',
+    ['reducer', 'scope', 'event_fields', 'events', 'exclude_events']
+)
 LAST_UPDATED = None
 
 
 def reducer_modules(source):
     '''
-    Helper.
+    Helper. Returns the tuple of `ReducerSpec`s for a source.
+
+    These are shared between connections, so there's no need to copy
+    them (and copying is expensive when a whole class connects at once).
 
     TODO: Somewhat obsolete, since a lot of this code will migrate into module_loader.
     '''
     global REDUCER_MODULES
-    modules = copy.deepcopy(REDUCER_MODULES.get(source, None))
+    modules = REDUCER_MODULES.get(source, None)
     if modules is None:
         debug_log("Unknown event source: " + str(source))
         debug_log("Known sources: " + repr(REDUCER_MODULES.keys()))
@@ -40,6 +59,71 @@ def reducer_modules(source):
     return modules
 
 
+def build_event_dispatch(modules):
+    '''
+    Build an event-type dispatch table for the reducers of one context.
+
+    Reducers may declare the event types they consume (`events`) or
+    the event types they ignore (`exclude_events`). Reducers with
+    neither see every event. We return a dictionary with:
+
+    * `events`: event type -> indexes of reducers (into `modules`)
+      which should see that event type, for every event type some
+      reducer mentions
+    * `default`: indexes of reducers which should see any other event
+
+    >>> spec = lambda events=None, exclude_events=None: ReducerSpec(None, (), (), events, exclude_events)
+    >>> table = build_event_dispatch([
+    ...     spec(events=['save']),
+    ...     spec(exclude_events=['visibility']),
+    ...     spec()
+    ... ])
+    >>> table['events']['save']
+    (0, 1, 2)
+    >>> table['events']['visibility']
+    (2,)
+    >>> table['default']
+    (1, 2)
+    '''
+    def consumes(module, event_type):
+        if module.events is not None and event_type not in module.events:
+            return False
+        return event_type not in (module.exclude_events or ())
+
+    event_types = set()
+    for module in modules:
+        event_types.update(module.events or ())
+        event_types.update(module.exclude_events or ())
+
+    return {
+        'events': {
+            event_type: tuple(
+                i for i, module in enumerate(modules) if consumes(module, event_type)
+            )
+            for event_type in event_types
+        },
+        'default': tuple(
+            i for i, module in enumerate(modules) if module.events is None
+        )
+    }
+
+
+def reducers_for_event(source, event_type):
+    '''
+    Which reducers (as indexes into `reducer_modules(source)`) should
+    see an event of type `event_type`? This lets the pipeline skip
+    reducers which would ignore the event anyways, without ever
+    calling them or touching the KVS.
+
+    Returns `None` if we don't have a dispatch table for the source,
+    in which case all reducers should see the event.
+    '''
+    dispatch = EVENT_DISPATCH.get(source)
+    if dispatch is None:
+        return None
+    return dispatch['events'].get(event_type, dispatch['default'])
+
+
 def async_lambda(function):
     '''Work-around for Python 3 issues with handling async
     functions. This turns a function into an asynchronous one. It
@@ -54,6 +138,28 @@ def async_lambda(function):
     return async_lambda_helper
 
 
+def compile_reducer(reducer, scope, events=None, exclude_events=None):
+    '''
+    Turn a reducer into a `ReducerSpec`. This is done once, at startup.
+    '''
+    import learning_observer.stream_analytics.helpers as helpers
+    # We're moving to this always being a co-routine. We started
+    # with a function, and had an interrim period where both
+    # functions and co-routines worked.
+    if not inspect.iscoroutinefunction(reducer):
+        debug_log("Not a coroutine", reducer)
+        raise AttributeError("The reducer {} should be a co-routine".format(reducer))
+    return ReducerSpec(
+        reducer=reducer,
+        scope=scope,
+        event_fields=tuple(
+            field.event for field in scope if isinstance(field, helpers.EventField)
+        ),
+        events=None if events is None else frozenset(events),
+        exclude_events=None if exclude_events is None else frozenset(exclude_events)
+    )
+
+
 def init():
     '''
     Initialize the stream analytics module. For now, this just populates
@@ -69,20 +175,24 @@ def init():
     srm = collections.defaultdict(lambda: list())
 
     # For debugging; this can go away at some point
-    srm['org.mitros.mirror'].append({'reducer': async_lambda(
-        lambda metadata: async_lambda(lambda event: event)
-    )})
+    srm['org.mitros.mirror'].append(compile_reducer(
+        async_lambda(lambda metadata: async_lambda(lambda event, event_fields={}: event)),
+        scope=()
+    ))
 
     reducers = learning_observer.module_loader.reducers()
     for reducer in reducers:
-        context = reducer['context']
-        function = reducer['function']
-        scope = reducer.get('scope', helpers.Scope([helpers.KeyField.STUDENT]))
-        srm[context].append({
-            'reducer': function,
-            'scope': scope
-        })
-
-    global REDUCER_MODULES, LAST_UPDATED
-    REDUCER_MODULES = dict(srm)
+        srm[reducer['context']].append(compile_reducer(
+            reducer['function'],
+            scope=reducer.get('scope', helpers.Scope([helpers.KeyField.STUDENT])),
+            events=reducer.get('events'),
+            exclude_events=reducer.get('exclude_events')
+        ))
+
+    global REDUCER_MODULES, EVENT_DISPATCH, LAST_UPDATED
+    REDUCER_MODULES = {context: tuple(modules) for context, modules in srm.items()}
+    EVENT_DISPATCH = {
+        context: build_event_dispatch(modules)
+        for context, modules in REDUCER_MODULES.items()
+    }
     LAST_UPDATED = learning_observer.util.generate_unique_token()
@@ -33,10 +33,16 @@ reducers (per-student, per-resource, etc.). For now, though, this
 works.
 '''
 
+import asyncio
 import copy
 import functools
+import time
 
+import pmss
+
+import learning_observer.change_notifications
 import learning_observer.kvs
+import learning_observer.settings
 from learning_observer.stream_analytics.fields import KeyStateType, KeyField, EventField, Scope
 
 from learning_observer.log_event import debug_log
@@ -45,6 +51,31 @@ from learning_observer.log_event import debug_log
 # some point.
 import learning_observer.module_loader
 
+pmss.register_field(
+    name='reducer_write_back_cache',
+    type=pmss.pmsstypes.TYPES.boolean,
+    description='Keep reducer state in memory for the duration of each websocket '\
+                'session, and write it back to the KVS periodically, rather than '\
+                'reading and writing the KVS on every event. This cuts KVS traffic '\
+                'substantially, at the cost of dashboards lagging by up to '\
+                '`reducer_write_back_seconds`.',
+    default=False
+)
+pmss.register_field(
+    name='reducer_write_back_seconds',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='With `reducer_write_back_cache`, the longest we hold modified '\
+                'reducer state in memory before writing it to the KVS.',
+    default=2
+)
+pmss.register_field(
+    name='reducer_write_back_events',
+    type=pmss.pmsstypes.TYPES.integer,
+    description='With `reducer_write_back_cache`, the most events we process '\
+                'before writing modified reducer state to the KVS.',
+    default=25
+)
+
 
 def fully_qualified_function_name(func):
     '''
@@ -181,11 +212,317 @@ def make_key(func, key_dict, state_type):
     return ",".join(key_list)
 
 
+# How many distinct sets of field values (e.g. student / document
+# pairs) we remember keys for, per reducer.
+KEY_CACHE_SIZE = 4096
+
+
+class KeyBuilder:
+    '''
+    A cached version of `make_key`, for one reducer and scope.
+
+    `make_key` is called twice per reducer per event (internal and
+    external state), and redoes the same work each time: looking up
+    the function name, sorting fields, and formatting. Here, we
+    compute the `Internal,module.reducer` / `External,module.reducer`
+    prefixes and the field order once, and keep an LRU cache of the
+    field part of the key, keyed on the field values.
+
+    >>> builder = KeyBuilder(make_key, Scope([KeyField.STUDENT, EventField('doc_id')]))
+    >>> internal_key, external_key = builder.keys({KeyField.STUDENT: 123, EventField('doc_id'): 'abc'})
+    >>> internal_key
+    'Internal,learning_observer.stream_analytics.helpers.make_key,EventField.doc_id:abc,STUDENT:123'
+    >>> internal_key == make_key(make_key, {KeyField.STUDENT: 123, EventField('doc_id'): 'abc'}, KeyStateType.INTERNAL)
+    True
+    >>> external_key
+    'External,learning_observer.stream_analytics.helpers.make_key,EventField.doc_id:abc,STUDENT:123'
+
+    `1`, `1.0`, and `True` are equal (and hash the same), but make
+    different keys, so the cache goes by type as well as value:
+
+    >>> builder = KeyBuilder(make_key, Scope([KeyField.STUDENT]))
+    >>> [builder.keys({KeyField.STUDENT: value})[0].split(',')[-1] for value in (1, True, 1.0)]
+    ['STUDENT:1', 'STUDENT:True', 'STUDENT:1.0']
+    '''
+    def __init__(self, func, scope, cache_size=KEY_CACHE_SIZE):
+        streammodule = fully_qualified_function_name(func)
+        self.internal_prefix = KeyStateType.INTERNAL.name.capitalize() + "," + streammodule
+        self.external_prefix = KeyStateType.EXTERNAL.name.capitalize() + "," + streammodule
+        self.fields = tuple(sorted(scope, key=lambda x: x.name))
+        # Values are passed as separate arguments, since `typed` only
+        # looks at the types of the arguments themselves
+        self._cached_suffix = functools.lru_cache(maxsize=cache_size, typed=True)(self._suffix)
+
+    def _suffix(self, *values):
+        '''
+        The field part of the key, e.g. `,EventField.doc_id:abc,STUDENT:123`
+        '''
+        return "".join(
+            ",{key}:{value}".format(key=field.name, value=value)
+            for field, value in zip(self.fields, values)
+        )
+
+    def keys(self, key_dict):
+        '''
+        Return the internal and external keys for `key_dict`, which
+        must have a value for every field in the scope.
+        '''
+        values = tuple(key_dict[field] for field in self.fields)
+        try:
+            suffix = self._cached_suffix(*values)
+        except TypeError:
+            # Unhashable values (e.g. a list sent by the client). Rare,
+            # so we don't bother caching.
+            suffix = self._suffix(*values)
+        return self.internal_prefix + suffix, self.external_prefix + suffix
+
+
+def parse_key(key):
+    '''
+    The inverse of `make_key`. Splits a KVS key into its state type,
+    reducer name, and fields. Field values stay strings.
+
+    >>> parse_key('Internal,some_module.reducer,EventField.doc_id:abc,STUDENT:123')
+    {'state_type': 'Internal', 'reducer': 'some_module.reducer', 'fields': {'EventField.doc_id': 'abc', 'STUDENT': '123'}}
+    '''
+    state_type, reducer, *fields = key.split(",")
+    return {
+        'state_type': state_type,
+        'reducer': reducer,
+        'fields': dict(field.split(":", 1) for field in fields)
+    }
+
+
+def _index_names(reducer, fields):
+    '''
+    The secondary indexes a key belongs in: one for its reducer, and
+    one per field value (e.g. one per student, one per document).
+
+    >>> _index_names('some_module.reducer', {'EventField.doc_id': 'abc', 'STUDENT': '123'})
+    ['REDUCER:some_module.reducer', 'EventField.doc_id:abc', 'STUDENT:123']
+    '''
+    return ["REDUCER:" + reducer] + [
+        "{key}:{value}".format(key=key, value=value)
+        for key, value in fields.items()
+        if value is not None
+    ]
+
+
+async def index_key(kvs, key, func, key_dict):
+    '''
+    Record `key` (as made by `make_key(func, key_dict, ...)`) in the
+    secondary indexes. `kvs_pipeline` calls this when it first creates
+    a key, so lookups like `students_for_document` are a set read
+    rather than a scan of the whole KVS.
+    '''
+    fields = {field.name: value for field, value in key_dict.items()}
+    await kvs.index_add(_index_names(fully_qualified_function_name(func), fields), key)
+
+
+async def rebuild_key_index(kvs=None):
+    '''
+    Index every existing internal key. This is one full scan, for data
+    written before we kept an index; afterwards, `kvs_pipeline` keeps
+    the index up-to-date.
+    '''
+    if kvs is None:
+        kvs = learning_observer.kvs.KVS()
+    async for key in kvs.iter_keys(prefix=KeyStateType.INTERNAL.name.capitalize() + ","):
+        parsed = parse_key(key)
+        await kvs.index_add(_index_names(parsed['reducer'], parsed['fields']), key)
+
+
+async def unindex_key(kvs, key):
+    '''
+    Remove `key` from the secondary indexes it's in. Call this when
+    removing a key.
+    '''
+    parsed = parse_key(key)
+    await kvs.index_remove(_index_names(parsed['reducer'], parsed['fields']), key)
+
+
+async def _live_index_members(kvs, index):
+    '''
+    The members of `index` whose keys still exist.
+
+    Keys can go away without us hearing about it (with `redis_ephemeral`,
+    they expire), and their index entries don't. So we check, and drop
+    missing keys from their indexes as we find them. That keeps indexes
+    which are read from growing without bound.
+    '''
+    members = sorted(await kvs.index_members(index))
+    live = set()
+    for key, exists in zip(members, await kvs.exists(members)):
+        if exists:
+            live.add(key)
+        else:
+            await unindex_key(kvs, key)
+    return live
+
+
+async def remove_reducer_keys(func, kvs=None):
+    '''
+    Remove everything the reducer `func` has written (internal and
+    external state), and take its keys out of the secondary indexes.
+    Returns how many keys we removed.
+
+    We match on the whole reducer name, so this doesn't touch reducers
+    whose names merely contain this one's.
+    '''
+    if kvs is None:
+        kvs = learning_observer.kvs.KVS()
+    name = fully_qualified_function_name(func)
+    removed = 0
+    for state_type in KeyStateType:
+        prefix = "{state_type},{name},".format(state_type=state_type.name.capitalize(), name=name)
+        # Collect first, so we are not deleting keys from under the scan
+        keys = [key async for key in kvs.iter_keys(prefix=prefix)]
+        for key in keys:
+            await kvs.remove(key)
+            if state_type == KeyStateType.INTERNAL:
+                await unindex_key(kvs, key)
+        removed += len(keys)
+    return removed
+
+
+async def keys_for_reducer(func, kvs=None):
+    '''
+    All (internal) keys written by the reducer `func`.
+    '''
+    if kvs is None:
+        kvs = learning_observer.kvs.KVS()
+    return await _live_index_members(kvs, "REDUCER:" + fully_qualified_function_name(func))
+
+
+async def keys_for_field(field, value, kvs=None):
+    '''
+    All (internal) keys with `field` set to `value`, across reducers. For
+    example, `keys_for_field(KeyField.STUDENT, student_id)`.
+    '''
+    if kvs is None:
+        kvs = learning_observer.kvs.KVS()
+    return await _live_index_members(kvs, "{key}:{value}".format(key=field.name, value=value))
+
+
+async def students_for_document(doc_id, kvs=None):
+    '''
+    Which students own (have events for) the document `doc_id`?
+    '''
+    keys = await keys_for_field(EventField('doc_id'), doc_id, kvs)
+    fields = (parse_key(key)['fields'] for key in keys)
+    return sorted({f[KeyField.STUDENT.name] for f in fields if KeyField.STUDENT.name in f})
+
+
+async def documents_for_reducer(func, kvs=None):
+    '''
+    Which documents does the reducer `func` have state for?
+    '''
+    doc_field = EventField('doc_id').name
+    fields = (parse_key(key)['fields'] for key in await keys_for_reducer(func, kvs))
+    return sorted({f[doc_field] for f in fields if f.get(doc_field, 'None') != 'None'})
+
+
+class WriteBackCache:
+    '''
+    An in-memory, per-connection cache of reducer state in front of the
+    KVS. Reads go to the KVS only the first time we see a key. Writes
+    are held in memory, and flushed (in a single `multiset`) once
+    `max_events` events have been processed, `interval` seconds after
+    the first unflushed write, or when the connection closes.
+
+    This is only safe since each key is normally written by one
+    connection at a time (see the concurrency notes in `kvs_pipeline`).
+    Note that reducers receive the cached object itself, so a reducer
+    should not modify its state in-place unless it also returns it.
+    '''
+    def __init__(self, kvs, interval, max_events):
+        self.kvs = kvs
+        self.interval = interval
+        self.max_events = max_events
+        self.state = {}
+        self.dirty = {}
+        self.events = 0
+        self.flush_task = None
+        self.notify = learning_observer.change_notifications.enabled()
+
+    async def get(self, key):
+        '''
+        Return the state for `key`, from memory if we have it.
+        '''
+        if key not in self.state:
+            self.state[key] = await self.kvs[key]
+        return self.state[key]
+
+    def set(self, key, value):
+        '''
+        Update `key` in memory, and schedule a flush.
+        '''
+        self.state[key] = value
+        self.dirty[key] = value
+        if self.flush_task is None and self.interval is not None:
+            self.flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def event_processed(self):
+        '''
+        Count an event, flushing if we've held writes for too many events.
+        '''
+        self.events += 1
+        if self.max_events is not None and self.events >= self.max_events:
+            await self.flush()
+
+    async def _delayed_flush(self):
+        # Nobody awaits this task, so we log failures here. The writes
+        # stay dirty, and go out with the next flush.
+        await asyncio.sleep(self.interval)
+        self.flush_task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            debug_log("Write-back cache flush failed:", e)
+
+    async def flush(self):
+        '''
+        Write all modified state back to the KVS.
+        '''
+        if self.flush_task is not None and self.flush_task is not asyncio.current_task():
+            self.flush_task.cancel()
+        self.flush_task = None
+        self.events = 0
+        if self.dirty:
+            dirty, self.dirty = self.dirty, {}
+            try:
+                await self.kvs.multiset(dirty)
+            except Exception:
+                # Keep the state for the next flush. Anything written
+                # while we were waiting is newer, so it wins.
+                self.dirty = {**dirty, **self.dirty}
+                raise
+            if self.notify:
+                learning_observer.change_notifications.changed(dirty)
+
+
+def write_back_cache(kvs):
+    '''
+    Return a `WriteBackCache` for a new connection if the write-back
+    cache is enabled in the settings, and `None` otherwise.
+    '''
+    settings = learning_observer.settings.pmss_settings
+    if not settings.reducer_write_back_cache(types=['reducers']):
+        return None
+    return WriteBackCache(
+        kvs,
+        interval=settings.reducer_write_back_seconds(types=['reducers']),
+        max_events=settings.reducer_write_back_events(types=['reducers'])
+    )
+
+
 def kvs_pipeline(
         null_state=None,
         scope=None,
         module_override=None,
-        qualname_override=None
+        qualname_override=None,
+        events=None,
+        exclude_events=None
 ):
     '''
     Closures, anyone?
@@ -199,6 +536,10 @@ def kvs_pipeline(
       happened. This can be important for the aggregator. We're documenting the
       code before we've written it, so please make sure this works before using.
     * `scope` tells us the scope we reduce over. See `fields.Scope`
+    * `events` is the list of event types the reducer consumes. If given,
+      the pipeline won't call the reducer (or fetch its state from the
+      KVS) for other events.
+    * `exclude_events` is the list of event types the reducer ignores.
     '''
     if scope is None:
         debug_log("TODO: explicitly specify a scope")
@@ -231,8 +572,11 @@ def kvs_pipeline(
         if module_override is not None:
             setattr(func, '__module__', module_override)
 
+        # Equivalent to `make_key`, but cached
+        key_builder = KeyBuilder(func, scope)
+
         @functools.wraps(func)
-        async def wrapper_closure(metadata):
+        async def wrapper_closure(metadata, named=None):
             '''
             The decorator itself. We create a function that, when called,
             creates an event processing pipeline. It keeps a pointer
@@ -240,8 +584,17 @@ def kvs_pipeline(
             its own KVS. This is the level at which we want consistency,
             want to allow sharding, etc. If two users are connected, each
             will have their own data store connection.
+
+            `versioned` copies (below) pass themselves as `named`, so
+            keys are named after them rather than `func`.
             '''
+            keys_for = key_builder if named is None else named.key_builder
+            keys_named_for = func if named is None else named
             taskkvs = learning_observer.kvs.KVS()
+            # Opt-in: keep state in memory for this connection
+            cache = write_back_cache(taskkvs)
+            # Opt-in: tell dashboards which keys we've written
+            notify = learning_observer.change_notifications.enabled()
 
             async def process_event(event, event_fields={}):
                 '''
@@ -312,21 +665,22 @@ def kvs_pipeline(
                     else:
                         raise Exception("Unknown field", field)
 
-                internal_key = make_key(
-                    func,
-                    keydict,
-                    KeyStateType.INTERNAL
-                )
-                external_key = make_key(
-                    func,
-                    keydict,
-                    KeyStateType.EXTERNAL
-                )
+                internal_key, external_key = keys_for.keys(keydict)
 
-                internal_state = await taskkvs[internal_key]
+                if cache is not None:
+                    internal_state = await cache.get(internal_key)
+                else:
+                    internal_state = await taskkvs[internal_key]
                 if internal_state is None:
                     internal_state = copy.deepcopy(null_state)
                     await taskkvs.set(internal_key, internal_state)
+                    if cache is not None:
+                        # Otherwise, the cache still has `None`, and we'd
+                        # be back here on the next event if the reducer
+                        # doesn't write
+                        cache.state[internal_key] = internal_state
+                    # New key, so it needs to go into the secondary indexes
+                    await index_key(taskkvs, internal_key, keys_named_for, keydict)
 
                 internal_state, external_state = await func(
                     event, internal_state
@@ -334,12 +688,55 @@ def kvs_pipeline(
 
                 # We would like to give reducers the option to /not/ write
                 # on all events
+                if cache is not None:
+                    if internal_state is not False:
+                        cache.set(internal_key, internal_state)
+                    if external_state is not False:
+                        cache.set(external_key, external_state)
+                    await cache.event_processed()
+                    return external_state
+
                 if internal_state is not False:
                     await taskkvs.set(internal_key, internal_state)
+                    if notify:
+                        learning_observer.change_notifications.changed([internal_key])
                 if external_state is not False:
                     await taskkvs.set(external_key, external_state)
+                    if notify:
+                        learning_observer.change_notifications.changed([external_key])
                 return external_state
+
+            async def flush():
+                '''
+                Write any state held in the write-back cache to the KVS.
+                This should be called when the connection closes.
+                '''
+                if cache is not None:
+                    await cache.flush()
+
+            process_event.flush = flush
             return process_event
+
+        def versioned(version):
+            '''
+            A copy of this reducer which keeps its state under keys of
+            its own, named for `<module>.<function>@<version>`. We use
+            this to backfill a changed reducer while the old version
+            carries on with the old keys.
+            '''
+            @functools.wraps(wrapper_closure)
+            async def versioned_closure(metadata):
+                return await wrapper_closure(metadata, named=versioned_closure)
+            versioned_closure.__qualname__ = "{qualname}@{version}".format(qualname=func.__qualname__, version=version)
+            versioned_closure.version = version
+            versioned_closure.key_builder = KeyBuilder(versioned_closure, scope)
+            return versioned_closure
+
+        # Used by `stream_analytics.init` to build the event dispatch table
+        wrapper_closure.events = None if events is None else frozenset(events)
+        wrapper_closure.exclude_events = None if exclude_events is None else frozenset(exclude_events)
+        wrapper_closure.versioned = versioned
+        wrapper_closure.version = None
         return wrapper_closure
     return decorator
 
@@ -0,0 +1,168 @@
+'''
+Micro-benchmarks for the event pipeline, which we can run without
+spinning up the Learning Observer.
+
+At the start of class, hundreds of Chromebooks connect at once, and
+each connection sets up its own event pipeline. We'd like that to be
+cheap. This script measures how long it takes to set up a pipeline
+for one connection, for the reducers installed on this system.
+
+It also measures the per-event cost of building KVS keys, with
+`make_key` versus the cached `KeyBuilder` which reducers use, and
+event throughput through a pipeline (with debug logging off, as in
+deployment).
+
+This runs against the in-memory KVS, so numbers are for our own
+overhead, and don't include e.g. round trips to redis.
+'''
+
+import argparse
+import asyncio
+import time
+
+import learning_observer.settings
+import learning_observer.stream_analytics
+import learning_observer.stream_analytics.helpers as helpers
+import learning_observer.module_loader
+import learning_observer.incoming_student_event
+import learning_observer.log_event
+import learning_observer.kvs
+
+
+# Supress printing of all the junk that happens during startup.
+learning_observer.log_event.DEBUG_LOG_LEVEL = learning_observer.log_event.LogLevel.NONE
+
+# Run from memory
+learning_observer.settings.load_settings({
+    "logging": {
+        "debug_log_level": "NONE",
+        "debug_log_destination": ["console"]
+    },
+    "kvs": {
+        "default": {
+            "type": "stub",
+        },
+    },
+    "config": {
+        "run_mode": "dev"
+    }
+})
+
+
+parser = argparse.ArgumentParser(
+    description=__doc__.strip(),
+    formatter_class=argparse.RawTextHelpFormatter
+)
+
+parser.add_argument("--source", "-s", default="org.mitros.writing_analytics",
+                    help="The event source to connect as")
+parser.add_argument("--connections", "-n", type=int, default=1000,
+                    help="The number of connections to set up")
+parser.add_argument("--events", "-e", type=int, default=100000,
+                    help="The number of events to build keys for")
+parser.add_argument("--students", type=int, default=30,
+                    help="The number of distinct students to build keys for")
+
+
+def report(name, count, seconds):
+    '''
+    Print a one-line summary of a benchmark
+    '''
+    print("{name}: {count} in {seconds:.3f}s ({per:.1f}us each)".format(
+        name=name,
+        count=count,
+        seconds=seconds,
+        per=seconds / count * 1e6
+    ))
+
+
+async def benchmark_connection_setup(source, connections):
+    '''
+    Time creating the per-connection event pipeline for `connections`
+    students.
+    '''
+    start = time.perf_counter()
+    for i in range(connections):
+        await learning_observer.incoming_student_event.student_event_pipeline({
+            "source": source,
+            "auth": {
+                "user_id": f"benchmark-{i}",
+                "safe_user_id": f"benchmark-{i}"
+            }
+        })
+    report("Connection setup", connections, time.perf_counter() - start)
+
+
+async def benchmark_event_throughput(source, events):
+    '''
+    Time pushing `events` synthetic events through one pipeline.
+    '''
+    pipeline = await learning_observer.incoming_student_event.student_event_pipeline({
+        "source": source,
+        "auth": {
+            "user_id": "benchmark",
+            "safe_user_id": "benchmark"
+        }
+    })
+    event = {
+        "client": {"event": "keystroke", "doc_id": "benchmark-doc", "source": source},
+        "server": {"time": time.time()},
+        "metadata": {}
+    }
+    start = time.perf_counter()
+    for i in range(events):
+        await pipeline(event)
+    await pipeline.flush()
+    report("Events through the pipeline", events, time.perf_counter() - start)
+
+
+def benchmark_key_construction(events, students):
+    '''
+    Time building the internal and external key for `events` events,
+    spread over `students` students and a handful of documents, for
+    a per-document reducer.
+    '''
+    async def reducer(event, internal_state):
+        return False, False
+
+    scope = helpers.Scope([helpers.KeyField.STUDENT, helpers.EventField('doc_id')])
+    key_dicts = [
+        {
+            helpers.KeyField.STUDENT: f"student-{i % students}",
+            helpers.EventField('doc_id'): f"doc-{i % (students * 3)}"
+        }
+        for i in range(events)
+    ]
+
+    start = time.perf_counter()
+    for key_dict in key_dicts:
+        helpers.make_key(reducer, key_dict, helpers.KeyStateType.INTERNAL)
+        helpers.make_key(reducer, key_dict, helpers.KeyStateType.EXTERNAL)
+    report("Keys with make_key", events, time.perf_counter() - start)
+
+    key_builder = helpers.KeyBuilder(reducer, scope)
+    start = time.perf_counter()
+    for key_dict in key_dicts:
+        key_builder.keys(key_dict)
+    report("Keys with KeyBuilder", events, time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    learning_observer.module_loader.reducers()
+    learning_observer.kvs.kvs_startup_check()
+    learning_observer.stream_analytics.init()
+
+    source = args.source
+    if source not in learning_observer.stream_analytics.REDUCER_MODULES:
+        print(f"No reducers for {source}. Falling back to the mirror module.")
+        source = "org.mitros.mirror"
+    print("{count} reducers for {source}".format(
+        count=len(learning_observer.stream_analytics.reducer_modules(source)),
+        source=source
+    ))
+
+    asyncio.run(benchmark_connection_setup(source, args.connections))
+    asyncio.run(benchmark_event_throughput(source, args.events))
+    benchmark_key_construction(args.events, args.students)
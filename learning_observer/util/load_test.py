@@ -0,0 +1,348 @@
+'''
+Load test
+
+Usage:
+    load_test.py [--url=<url>] [--students=<n>] [--rate=<rate>]
+                 [--duration=<sec>] [--mix=<mix>] [--ack-every=<n>]
+                 [--status-url=<url>] [--logs=<filelist>]
+
+Options:
+    --url=<url>         URL to connect [default: http://localhost:8888/wsapi/in/]
+    --students=<n>      Students to simulate, each on their own websocket [default: 30]
+    --rate=<rate>       Mean events per second, per student [default: 5]
+    --duration=<sec>    How long to send events for [default: 60]
+    --mix=<mix>         Mix of synthetic events, as type:weight,... [default: google_docs_save:8,keystroke:8,visibility:1]
+    --ack-every=<n>     Ask the server to acknowledge every n-th event [default: 10]
+    --status-url=<url>  Status page, for server-side KVS counts [default: http://localhost:8888/admin/status]
+    --logs=<filelist>   Replay client events from these (comma-separated) logs, rather than synthetic events
+
+Overview:
+    restream.py and stream_writing.py are good for watching a few
+    students on a dashboard. This is for finding out how many students
+    a server can handle, e.g. to plan capacity before a school year.
+
+    We open one websocket per student, identify as in stream_writing.py,
+    and send events at random (Poisson) intervals. Events are either
+    synthetic (in the given mix, with essays from synthetic_student_data)
+    or client events replayed from real logs (`.log` or `.study.log`,
+    ignoring the original timing). Sending doesn't wait on the server,
+    so if the server falls behind, latency goes up.
+
+    At the end, we report:
+    * Throughput, in events per second
+    * Latency from sending an event to the server acknowledging it, once
+      it has been through the reducers. This needs the `event_acks`
+      feature flag on the server.
+    * KVS operations on the server, from the status page. This needs
+      the status page to be reachable without logging in (e.g. with
+      test case auth); otherwise we skip it.
+
+    The server needs to accept `test_framework_fake_identity` events
+    (`event_auth: testcase_auth`). It works with the `stub` KVS or a
+    local redis.
+'''
+
+import asyncio
+import json
+import math
+import random
+import sys
+import time
+
+import aiohttp
+import docopt
+
+SOURCE = "org.mitros.writing_analytics"
+
+# Events we don't replay from logs. The server adds auth, and we do
+# our own identification.
+HEADER_EVENTS = {'test_framework_fake_identity', 'metadata_finished', 'lock_fields'}
+
+
+def current_millis():
+    return round(time.time() * 1000)
+
+
+def identify(user):
+    '''
+    Header events identifying the user, as in `stream_writing.py`
+    '''
+    return [
+        {
+            "event": "test_framework_fake_identity",
+            "source": SOURCE,
+            "user_id": user,
+            "origin": "load_test_script"
+        }, {
+            "event": "metadata_finished",
+            "source": SOURCE,
+            "origin": "load_test_script"
+        }
+    ]
+
+
+def google_docs_save(text, index, doc_id):
+    '''
+    A minimal one-character insert, as in `stream_writing.py`
+    '''
+    return {
+        "bundles": [{'commands': [{"ibi": index + 1, "s": text[index % len(text)], "ty": "is"}]}],
+        "event": "google_docs_save",
+        "doc_id": doc_id,
+    }
+
+
+def keystroke(text, index, doc_id):
+    return {
+        "event": "keystroke",
+        "keystroke": {
+            "key": text[index % len(text)],
+            "keyCode": ord(text[index % len(text)]),
+            "timeStamp": current_millis()
+        },
+        "doc_id": doc_id,
+    }
+
+
+def visibility(text, index, doc_id):
+    return {
+        "event": "visibility",
+        "visibility": random.choice(["visible", "hidden"]),
+        "doc_id": doc_id,
+    }
+
+
+EVENT_TYPES = {
+    "google_docs_save": google_docs_save,
+    "keystroke": keystroke,
+    "visibility": visibility
+}
+
+
+def parse_mix(mix):
+    '''
+    Parse an event mix.
+
+    >>> parse_mix("keystroke:3,visibility:1")
+    {'keystroke': 3.0, 'visibility': 1.0}
+    '''
+    weights = {}
+    for item in mix.split(","):
+        event_type, weight = item.split(":")
+        if event_type not in EVENT_TYPES:
+            raise ValueError(f"Unknown event type {event_type}. We know {list(EVENT_TYPES)}")
+        weights[event_type] = float(weight)
+    return weights
+
+
+def synthetic_events(student, mix):
+    '''
+    An endless stream of synthetic client events for one student.
+    '''
+    # Imported here, since this pulls in a bunch of dependencies we
+    # don't need when replaying logs
+    import learning_observer.synthetic_student_data
+
+    # We make the essay up front, rather than on the first event, so
+    # it's not part of what we're timing
+    text = learning_observer.synthetic_student_data.synthetic_student_data(student)['essay'] or "lorem ipsum"
+    doc_id = f"load-test-doc-{student}"
+    event_types = list(mix)
+    weights = [mix[event_type] for event_type in event_types]
+
+    def events():
+        index = 0
+        while True:
+            event_type = random.choices(event_types, weights)[0]
+            event = EVENT_TYPES[event_type](text, index, doc_id)
+            event["source"] = SOURCE
+            event["origin"] = "load_test_script"
+            event["timestamp"] = current_millis()
+            index += 1
+            yield event
+    return events()
+
+
+def load_log_events(filename):
+    '''
+    The client events from a log file. Study logs have the whole event
+    (and a timestamp); per-session logs have just the client event.
+    '''
+    events = []
+    with open(filename) as fp:
+        for line in fp:
+            line = line.split('\t', 1)[0].strip()
+            if not line:
+                continue
+            event = json.loads(line)
+            event = event.get('client', event)
+            if event.get('event') in HEADER_EVENTS:
+                continue
+            event.pop('auth', None)
+            events.append(event)
+    return events
+
+
+def log_events(events):
+    '''
+    An endless stream of client events, cycling through `events`.
+    '''
+    while True:
+        for event in events:
+            yield dict(event)
+
+
+def percentile(values, p):
+    '''
+    Nearest-rank percentile.
+
+    >>> percentile([4, 1, 3, 2], 50)
+    2
+    >>> percentile(list(range(1, 101)), 99)
+    99
+    >>> percentile([], 50) is None
+    True
+    '''
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+async def simulate_student(url, student, events, rate, duration, ack_every, stats):
+    '''
+    Send `events` over one websocket at a mean of `rate` per second,
+    for `duration` seconds. Results go into `stats`.
+    '''
+    pending = {}  # ack ID -> time sent
+
+    async def read_acks(web_socket):
+        async for msg in web_socket:
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                continue
+            message = json.loads(msg.data)
+            if message.get('status') == 'ack' and message.get('ack') in pending:
+                stats['latencies'].append(time.perf_counter() - pending.pop(message['ack']))
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.ws_connect(url) as web_socket:
+                reader = asyncio.create_task(read_acks(web_socket))
+                for header in identify(f"load-test-{student}"):
+                    await web_socket.send_str(json.dumps(header))
+                start = time.perf_counter()
+                if stats['start'] is None:
+                    stats['start'] = start
+                next_send = start
+                count = 0
+                while next_send < start + duration:
+                    # Open-loop: we send on schedule, whether or not the
+                    # server has kept up. If we're behind, we don't sleep.
+                    delay = next_send - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    event = next(events)
+                    if ack_every and count % ack_every == 0:
+                        ack = f"{student}-{count}"
+                        event['ack'] = ack
+                        pending[ack] = time.perf_counter()
+                        stats['acks_requested'] += 1
+                    await web_socket.send_str(json.dumps(event))
+                    stats['sent'] += 1
+                    stats['last_send'] = time.perf_counter()
+                    count += 1
+                    next_send += random.expovariate(rate)
+                # Give the server a few seconds to catch up on acks
+                wait_until = time.perf_counter() + 5
+                while pending and time.perf_counter() < wait_until:
+                    await asyncio.sleep(0.1)
+                reader.cancel()
+    except aiohttp.client_exceptions.ClientConnectorError:
+        stats['connection_errors'] += 1
+
+
+async def kvs_operations(session, status_url):
+    '''
+    Server-side KVS operation counts from the status page, or `None`
+    if we can't get them.
+    '''
+    try:
+        async with session.get(status_url) as response:
+            if response.status != 200:
+                return None
+            return (await response.json(content_type=None)).get('kvs_operations')
+    except (aiohttp.ClientError, ValueError):
+        return None
+
+
+def report(args, stats, kvs_before, kvs_after):
+    students = int(args['--students'])
+    # From the first event sent to the last, so not counting connecting,
+    # or waiting for the last acks
+    elapsed = max(stats['last_send'] - (stats['start'] or 0), 1e-6)
+    print(f"{students} students for {elapsed:.1f}s")
+    if stats['connection_errors']:
+        print(f"{stats['connection_errors']} students could not connect")
+    print("Sent {sent} events: {rate:.0f} events/second".format(
+        sent=stats['sent'],
+        rate=stats['sent'] / elapsed
+    ))
+    latencies = stats['latencies']
+    if latencies:
+        print("Acks: {received} of {requested}. Latency p50 {p50:.1f}ms, p99 {p99:.1f}ms".format(
+            received=len(latencies),
+            requested=stats['acks_requested'],
+            p50=percentile(latencies, 50) * 1000,
+            p99=percentile(latencies, 99) * 1000
+        ))
+    elif stats['acks_requested']:
+        print("No acks. Is the `event_acks` feature flag on?")
+    if kvs_before is None or kvs_after is None:
+        print("No KVS counts (is the status page reachable?)")
+        return
+    for operation in sorted(kvs_after):
+        count = kvs_after[operation] - kvs_before.get(operation, 0)
+        print("KVS {operation}: {count} ({per:.2f} per event)".format(
+            operation=operation,
+            count=count,
+            per=count / max(stats['sent'], 1)
+        ))
+
+
+async def run(args):
+    students = int(args['--students'])
+    rate = float(args['--rate'])
+    duration = float(args['--duration'])
+    ack_every = int(args['--ack-every'])
+
+    if args['--logs']:
+        logs = [load_log_events(filename) for filename in args['--logs'].split(",")]
+        streams = [log_events(logs[i % len(logs)]) for i in range(students)]
+    else:
+        mix = parse_mix(args['--mix'])
+        streams = [synthetic_events(i, mix) for i in range(students)]
+
+    stats = {
+        'sent': 0,
+        'acks_requested': 0,
+        'latencies': [],
+        'connection_errors': 0,
+        'start': None,
+        'last_send': 0
+    }
+    async with aiohttp.ClientSession() as session:
+        kvs_before = await kvs_operations(session, args['--status-url'])
+        await asyncio.gather(*[
+            simulate_student(args['--url'], i, streams[i], rate, duration, ack_every, stats)
+            for i in range(students)
+        ])
+        kvs_after = await kvs_operations(session, args['--status-url'])
+    report(args, stats, kvs_before, kvs_after)
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(run(docopt.docopt(__doc__)))
+    except aiohttp.client_exceptions.ServerDisconnectedError:
+        print("Could not connect to server")
+        sys.exit(-1)
@@ -184,7 +184,7 @@ async def binned_time_on_task(event, internal_state):
     return internal_state, internal_state
 
 
-@kvs_pipeline(scope=gdoc_scope)
+@kvs_pipeline(scope=gdoc_scope, events=['google_docs_save', 'document_history'])
 async def reconstruct(event, internal_state):
     '''
     This is a thin layer to route events to `reconstruct_doc` which compiles
@@ -243,7 +243,7 @@ async def languagetool_process(event, internal_state):
     return False, False
 
 
-@kvs_pipeline(scope=student_scope, null_state={'timestamps': {}, 'last_document': ''})
+@kvs_pipeline(scope=student_scope, null_state={'timestamps': {}, 'last_document': ''}, exclude_events=['visibility'])
 async def document_access_timestamps(event, internal_state):
     '''
     We want to fetch documents around a certian time of day.
@@ -276,7 +276,7 @@ async def document_access_timestamps(event, internal_state):
     return False, False
 
 
-@kvs_pipeline(scope=student_scope, null_state={'tags': {}})
+@kvs_pipeline(scope=student_scope, null_state={'tags': {}}, events=['document_history'])
 async def document_tagging(event, internal_state):
     '''
     We would like to be able to group documents together to better work with